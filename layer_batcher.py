@@ -0,0 +1,240 @@
+import time
+
+import numpy as np
+import cv2
+from panda3d.core import (
+    Geom, GeomNode, GeomTriangles, GeomVertexArrayFormat, GeomVertexData, GeomVertexFormat,
+    InternalName, Point3, TransparencyAttrib
+)
+
+from shaders import make_batch_shader
+from texture_builder import build_mask_image, make_texture_array
+
+# Vertex layout of a chunk: position, exposure color and (u, v, texture array page)
+_ARRAY_FORMAT = GeomVertexArrayFormat()
+_ARRAY_FORMAT.addColumn(InternalName.getVertex(), 3, Geom.NT_float32, Geom.C_point)
+_ARRAY_FORMAT.addColumn(InternalName.getColor(), 4, Geom.NT_float32, Geom.C_color)
+_ARRAY_FORMAT.addColumn(InternalName.getTexcoord(), 3, Geom.NT_float32, Geom.C_texcoord)
+VERTEX_FORMAT = GeomVertexFormat.registerFormat(GeomVertexFormat(_ARRAY_FORMAT))
+
+# Corners of a card in card space (x, z) and their texture coordinates (u, v)
+_CORNERS = np.array([[-0.5, -0.5], [0.5, -0.5], [0.5, 0.5], [-0.5, 0.5]], dtype=np.float32)
+_CORNER_UVS = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.float32)
+_QUAD_INDICES = np.array([0, 1, 2, 0, 2, 3], dtype=np.uint32)
+
+
+class LayerChunk:
+    """A run of consecutive layers drawn as one Geom with its own texture array."""
+    def __init__(self, first, last):
+        self.first = first           # first sequence number in the chunk
+        self.last = last             # last sequence number in the chunk
+        self.node = None
+        self.texture = None
+        self.level = None            # pyramid level of the texture
+        self.job = None              # future of the texture being assembled on the thread pool
+        self.pages = {}              # image_id -> page index in the chunk's texture array
+        self.drawn = None            # sequence numbers currently in the geometry
+        self.far_first = False
+        self.image_types = set()
+        self.exposures = set()
+
+
+class LayerBatcher:
+    """Merges the cards of every N consecutive layers into a single Geom.
+
+    Each chunk is one node with per-vertex exposure colors and (u, v, page)
+    coordinates into a per-chunk texture array, so the scene graph holds one node
+    per chunk instead of one per slice image. Hidden cards are left out of the
+    geometry; toggles and range changes only rebuild the chunks they touch.
+    Chunk textures are assembled on the viewer's thread pool and attached by
+    attach_ready, a few per frame.
+    """
+    def __init__(self, viewer, epsilon, chunk_layers):
+        self.viewer = viewer
+        self.epsilon = epsilon
+        self.chunk_layers = max(1, chunk_layers)
+        self.shader = make_batch_shader()
+        self.chunks = []
+        self.building = []           # chunks whose texture is being assembled
+        self.scale = 1.0
+        self.spacing = 0.0
+        self.aspect = 1.0
+
+    def clear(self):
+        for chunk in self.chunks:
+            if chunk.node is not None:
+                chunk.node.removeNode()
+        self.chunks = []
+        self.building = []
+
+    def build(self):
+        """Split the print into chunks and build the ones in the visible range."""
+        v = self.viewer
+        self.clear()
+        if not v.slice_data:
+            return
+        height, width = v.image_store.shape(v.slice_data[0]['image_ids'][0])
+        self.spacing, self.scale = v._layer_geometry(height, width)
+        self.aspect = width / height
+        for first in range(1, len(v.slice_data) + 1, self.chunk_layers):
+            chunk = LayerChunk(first, min(first + self.chunk_layers - 1, len(v.slice_data)))
+            for seq in range(chunk.first, chunk.last + 1):
+                for td in v.slice_data[seq - 1]['texture_data']:
+                    chunk.image_types.add(td['image_type'])
+                    chunk.exposures.add(td.get('exposure_time'))
+            self.chunks.append(chunk)
+        self.set_range()
+
+    def rebuild_textures(self):
+        """Rebuild the chunk textures at the current level, e.g. after a quality change.
+
+        Shown chunks keep drawing their old texture until the new one is attached;
+        the others drop theirs and are rebuilt when they come into range.
+        """
+        for chunk in self.chunks:
+            chunk.job = None
+            if chunk.node is None or chunk.node.isHidden():
+                chunk.texture = None
+                chunk.drawn = None
+        self.building = []
+        self.set_range()
+
+    def pending(self):
+        """Return True while chunk textures are being assembled."""
+        return bool(self.building)
+
+    def attach_ready(self, deadline):
+        """Attach finished chunk textures until the deadline (at least one); return True if any were."""
+        v = self.viewer
+        attached = False
+        for chunk in [c for c in self.building if c.job.done()]:
+            if attached and time.perf_counter() >= deadline:
+                break
+            self.building.remove(chunk)
+            level, pages, texture = chunk.job.result()
+            chunk.job = None
+            if level == v.texture_level:
+                chunk.level, chunk.pages, chunk.texture = level, pages, texture
+                chunk.drawn = None
+            # A texture for an older level is dropped and the chunk resubmitted
+            self._fill_chunk(chunk)
+            attached = True
+        return attached
+
+    def set_range(self):
+        """Rebuild only the chunks whose visible layers changed."""
+        if not self.chunks:
+            self.build()
+            return
+        for chunk in self.chunks:
+            self._fill_chunk(chunk)
+
+    def set_toggles(self, image_type=None, exposure=None):
+        """Rebuild the chunks containing cards of a toggled image type or exposure."""
+        for chunk in self.chunks:
+            if image_type is not None and image_type not in chunk.image_types:
+                continue
+            if exposure is not None and exposure not in chunk.exposures:
+                continue
+            chunk.drawn = None
+            self._fill_chunk(chunk)
+
+    def update_draw_order(self, camera):
+        """Reverse a chunk's card order when the camera crosses it, keeping back-to-front."""
+        for chunk in self.chunks:
+            if chunk.node is None or chunk.node.isHidden():
+                continue
+            cam_y = chunk.node.getRelativePoint(camera, Point3(0, 0, 0)).getY()
+            mid_y = -(chunk.first + chunk.last) / 2 * self.spacing / self.scale
+            far_first = cam_y > mid_y
+            if far_first != chunk.far_first:
+                chunk.far_first = far_first
+                chunk.drawn = None
+                self._fill_chunk(chunk)
+
+    def _visible_seqs(self, chunk):
+        v = self.viewer
+        top = v.visible_range['top']
+        bot = v.visible_range['bottom']
+        first = max(chunk.first, bot if bot is not None else chunk.first)
+        last = min(chunk.last, top if top is not None else chunk.last)
+        return range(first, last + 1)
+
+    def _submit_texture(self, chunk):
+        v = self.viewer
+        image_ids = sorted({image_id for seq in range(chunk.first, chunk.last + 1)
+                            for image_id in v.slice_data[seq - 1]['image_ids']})
+        chunk.job = v.thread_pool.submit(self._build_texture, image_ids, v.texture_level)
+        self.building.append(chunk)
+
+    def _build_texture(self, image_ids, level):
+        """Worker side: return (level, page map, texture array) for a chunk's images."""
+        v = self.viewer
+        images = [build_mask_image(v.image_store.get_mask(image_id, level)) for image_id in image_ids]
+        h, w = images[0].shape
+        pages = np.empty((len(images), h, w), dtype=np.uint8)
+        for page, img in enumerate(images):
+            if img.shape != (h, w):
+                img = cv2.resize(img, (w, h), interpolation=cv2.INTER_NEAREST)
+            pages[page] = img
+        page_map = {image_id: page for page, image_id in enumerate(image_ids)}
+        return level, page_map, make_texture_array(pages, compress=level > 0, mipmap=True)
+
+    def _fill_chunk(self, chunk):
+        v = self.viewer
+        seqs = list(self._visible_seqs(chunk))
+        if seqs and chunk.level != v.texture_level and chunk.job is None:
+            self._submit_texture(chunk)
+        # Without a texture the chunk is drawn once attach_ready brings one
+        if chunk.drawn == seqs or chunk.texture is None:
+            return
+        chunk.drawn = seqs
+
+        cards = []
+        for seq in (reversed(seqs) if chunk.far_first else seqs):
+            for idx, td in enumerate(v.slice_data[seq - 1]['texture_data']):
+                if td['image_type'] in v.enabled_types and td.get('exposure_time') in v.enabled_exposures:
+                    cards.append((seq, idx, td))
+        if not cards:
+            if chunk.node is not None:
+                chunk.node.hide()
+            return
+
+        if chunk.node is None:
+            chunk.node = v.root.attachNewNode(GeomNode(f"chunk_{chunk.first}"))
+            chunk.node.setR(90)
+            chunk.node.setScale(self.scale)
+            chunk.node.setTwoSided(True)
+            chunk.node.setTransparency(TransparencyAttrib.MAlpha)
+            chunk.node.setDepthWrite(False)
+            chunk.node.setBin("transparent", 0)
+            chunk.node.setShader(self.shader)
+        chunk.node.setShaderInput("chunk_pages", chunk.texture)
+        chunk.node.show()
+
+        # Four vertices per card: x, y, z, r, g, b, a, u, v, page
+        n = len(cards)
+        vertices = np.empty((n, 4, 10), dtype=np.float32)
+        for i, (seq, idx, td) in enumerate(cards):
+            r, g, b = v.exposure_colors.get(td.get('exposure_time'), (1.0, 1.0, 1.0))
+            vertices[i, :, 1] = -seq * self.spacing / self.scale + idx * self.epsilon
+            vertices[i, :, 3:7] = (r, g, b, 1.0)
+            vertices[i, :, 9] = chunk.pages[td['image_id']]
+        vertices[:, :, 0] = _CORNERS[:, 0] * self.aspect
+        vertices[:, :, 2] = _CORNERS[:, 1]
+        vertices[:, :, 7:9] = _CORNER_UVS
+
+        vdata = GeomVertexData("chunk", VERTEX_FORMAT, Geom.UH_static)
+        vdata.uncleanSetNumRows(n * 4)
+        vdata.modifyArrayHandle(0).copyDataFrom(vertices)
+
+        tris = GeomTriangles(Geom.UH_static)
+        tris.setIndexType(Geom.NT_uint32)
+        indices = (_QUAD_INDICES + 4 * np.arange(n, dtype=np.uint32)[:, None]).ravel()
+        tris.modifyVertices().modifyHandle().copyDataFrom(indices)
+
+        geom = Geom(vdata)
+        geom.addPrimitive(tris)
+        geom_node = chunk.node.node()
+        geom_node.removeAllGeoms()
+        geom_node.addGeom(geom)
@@ -0,0 +1,160 @@
+import heapq
+import time
+
+import numpy as np
+from panda3d.core import Point3
+
+from slice_store import PYRAMID_SCALES
+from texture_builder import FAST_LEVEL
+
+# Reduced level scales, finest first (1/4, 1/16, ...)
+_REDUCED_SCALES = np.array(PYRAMID_SCALES[1:])
+
+
+def level_for_ratio(ratio):
+    """Return the coarsest pyramid level that still has a texel per screen pixel.
+
+    `ratio` is the number of screen pixels covered by one full-size slice pixel
+    (a scalar or an array).
+    """
+    return (_REDUCED_SCALES >= np.asarray(ratio)[..., None]).sum(axis=-1)
+
+
+class LODManager:
+    """Streams per-layer texture levels in the card render mode.
+
+    Whenever the camera, the scene root, the visible range or the quality mode
+    changes, every shown layer's projected size is computed (vectorized) and the
+    layers whose level should change go into a priority queue: upgrades of the
+    layers largest on screen first, then downgrades. Each frame only pops as many
+    layers as fit in the upload budget, so a mode switch never stalls a frame.
+    Layers whose textures are not cached yet are built on the viewer's thread
+    pool and re-textured once ready, within the frame build budget.
+    """
+    def __init__(self, viewer, upload_budget_bytes):
+        self.viewer = viewer
+        self.upload_budget_bytes = upload_budget_bytes
+        self.levels = {}        # seq -> pyramid level applied to the layer's cards
+        self.queue = []         # heap of (downgrade, -footprint, seq, level)
+        self.building = {}      # seq -> (level, future) of the textures being built on the pool
+        self._view_key = None
+        self._report_done = False
+        self._release_pending = False
+
+    def reset(self):
+        self.levels = {}
+        self.queue = []
+        self.building = {}
+        self._view_key = None
+        self._report_done = False
+        self._release_pending = False
+
+    def set_level(self, seq, level):
+        """Record the level a layer was created with."""
+        self.levels[seq] = level
+
+    def invalidate(self, retexture=False):
+        """Recompute every layer's level on the next update; `retexture` forces all layers to refresh."""
+        if retexture:
+            self.levels = {seq: None for seq in self.levels}
+            # Textures in flight may be for the old mode
+            self.building = {}
+        self._view_key = None
+        self._report_done = True
+
+    def pending(self):
+        """Return True while layers are queued or their textures are being built."""
+        return bool(self.queue or self.building)
+
+    def _current_view_key(self):
+        v = self.viewer
+        mat = v.root.getMat(v.base.camera)
+        return (tuple(tuple(row) for row in mat), v.quality_mode, v.base.win.getYSize(),
+                len(v.layer_cards), v.visible_range['top'], v.visible_range['bottom'],
+                v.residency.view_key())
+
+    def desired_levels(self, seqs):
+        """Return (levels, footprints in screen pixels, camera distances) for the given layers."""
+        v = self.viewer
+        seqs = np.asarray(seqs, dtype=np.float64)
+        height, width = v.image_store.shape(v.slice_data[0]['image_ids'][0])
+        spacing, scale = v._layer_geometry(height, width)
+        # Layer centers are at (0, -seq * spacing, 0) in root space
+        cam = v.root.getRelativePoint(v.base.camera, Point3(0, 0, 0))
+        dist = np.sqrt(cam.getX() ** 2 + (cam.getY() + seqs * spacing) ** 2 + cam.getZ() ** 2)
+        fov_v = np.deg2rad(v.base.camLens.getFov()[1])
+        footprint = scale / (2 * np.maximum(dist, 1e-6) * np.tan(fov_v / 2)) * v.base.win.getYSize()
+        if v.quality_mode == "quality":
+            levels = np.zeros(len(seqs), dtype=int)
+        elif v.quality_mode == "fast":
+            levels = np.full(len(seqs), FAST_LEVEL)
+        else:
+            levels = level_for_ratio(footprint / height)
+        return levels, footprint, dist
+
+    def _schedule(self):
+        v = self.viewer
+        seqs = sorted(v.shown_layers)
+        self.queue = []
+        if not seqs:
+            return
+        levels, footprint, dist = self.desired_levels(seqs)
+        # Off-screen, occluded and over-budget layers are coarsened
+        levels = v.residency.adjust(seqs, levels, dist)
+        desired = dict(zip(seqs, levels.tolist()))
+        # Builds for a level the layer no longer wants are dropped
+        self.building = {seq: job for seq, job in self.building.items() if desired.get(seq) == job[0]}
+        for seq, level, fp in zip(seqs, levels.tolist(), footprint.tolist()):
+            current = self.levels.get(seq)
+            if level != current:
+                downgrade = current is not None and level > current
+                self.queue.append((downgrade, -fp, seq, level))
+        heapq.heapify(self.queue)
+
+    def update(self):
+        """Reschedule on view changes and apply queued levels within the per-frame budget."""
+        v = self.viewer
+        if not v.layer_cards:
+            return
+        key = self._current_view_key()
+        if key != self._view_key:
+            self._view_key = key
+            self._schedule()
+            self._release_pending = True
+
+        # Re-texture layers whose textures were built, at least one per frame
+        deadline = v._frame_deadline()
+        applied = False
+        for seq, (level, future) in list(self.building.items()):
+            if not future.done():
+                continue
+            if applied and time.perf_counter() >= deadline:
+                break
+            del self.building[seq]
+            future.result()
+            if seq in v.shown_layers:
+                v._apply_layer_level(seq, level)
+                self.levels[seq] = level
+            applied = True
+
+        budget = self.upload_budget_bytes
+        while self.queue and budget > 0 and time.perf_counter() < deadline:
+            _, _, seq, level = heapq.heappop(self.queue)
+            if seq not in v.shown_layers or self.levels.get(seq) == level:
+                continue
+            if v._layer_level_ready(seq, level):
+                v._apply_layer_level(seq, level)
+                self.levels[seq] = level
+            elif self.building.get(seq, (None,))[0] != level:
+                self.building[seq] = (level, v.thread_pool.submit(v._build_layer_level, seq, level))
+            budget -= v._layer_level_bytes(seq, level)
+
+        if self.pending():
+            return
+        if self._release_pending:
+            # Every layer is at its new level: free textures nothing uses any more
+            self._release_pending = False
+            v.residency.release_unused()
+        if self._report_done:
+            self._report_done = False
+            v._on_quality_update_done()
@@ -1,16 +1,28 @@
 import os
-from PIL import Image
-import numpy as np
-from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
 from print_settings_parser import PrintSettingsParser, LayerInfo
+from slice_store import SliceStore, decode_slice
+from volume_file import read_volume, write_volume
 
 class PrintProcessor:
-    def __init__(self, texture_cache, on_status_update=None, on_progress_update=None):
-        self.texture_cache = texture_cache
+    def __init__(self, on_status_update=None, on_progress_update=None, max_workers=None,
+                 packed_masks=False, slice_cache=None):
         self.slice_data = []
         self.settings_parser = PrintSettingsParser()
         self.pixel_size = 7.6  # microns
         self.layer_height = 10  # microns
+        # Number of threads used to decode slice images (PNG decoding releases the GIL)
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        # One array per unique image; layers only hold integer handles into it.
+        # With packed_masks the store keeps bit-packed binary masks instead.
+        self.image_store = SliceStore(packed=packed_masks)
+        # Optional persistent SliceCache used to skip decoding unchanged prints
+        self.slice_cache = slice_cache
+        self.directory_path = None
+        self.settings_path = None
+        # Open VolumeFile when loaded from a volume (keeps the memory map alive)
+        self.volume = None
         # Callback functions for status and progress updates
         self.on_status_update = on_status_update
         self.on_progress_update = on_progress_update
@@ -33,18 +45,14 @@ class PrintProcessor:
             
         # Load print settings
         settings_path = os.path.join(directory_path, settings_files[0])
+        self.directory_path = directory_path
+        self.settings_path = settings_path
         if self.on_status_update:
             self.on_status_update(f"Loading settings: {settings_path}")
         self.settings_parser.load_settings(settings_path)
         self.layer_height = self.settings_parser.get_layer_height()
         self.pixel_size = self.settings_parser.get_pixel_size()
 
-        # Prepare progress tracking
-        layer_sequence = self.settings_parser.layer_sequence
-        # Compute total images for progress calculation
-        self.total_images = sum(len(layer.images) for layer in layer_sequence)
-        self.images_loaded = 0
-
         # Phase: Finding images (verify slices directory)
         if self.on_status_update:
             self.on_status_update("Finding images")
@@ -60,6 +68,42 @@ class PrintProcessor:
         # Return True to indicate success.
         return True
 
+    def load_volume_file(self, volume_path: str) -> bool:
+        """Load a print from a volume file written by export_volume"""
+        if self.on_status_update:
+            self.on_status_update(f"Opening volume: {volume_path}")
+        if not os.path.exists(volume_path):
+            raise FileNotFoundError(f"Volume file not found: {volume_path}")
+
+        volume = read_volume(volume_path)
+        self.volume = volume
+        self.layer_height = volume.layer_height
+        self.pixel_size = volume.pixel_size
+        self.settings_parser.layer_sequence = volume.layer_sequence()
+        self.settings_parser.unique_images = {
+            image_info.image_file
+            for layer_info in self.settings_parser.layer_sequence
+            for image_info in layer_info.images
+        }
+
+        # Zero-copy views into the memory-mapped slice data
+        volume.fill_store(self.image_store)
+        self.total_images = self.images_loaded = len(self.image_store.paths())
+        if self.on_progress_update:
+            self.on_progress_update(100, f"Loaded {self.total_images} images from volume")
+
+        if self.on_status_update:
+            self.on_status_update("Loading layers")
+        self._build_slice_data()
+        return True
+
+    def export_volume(self, volume_path: str) -> None:
+        """Write the loaded print (slices and layer sequence) to a single volume file"""
+        if self.on_status_update:
+            self.on_status_update(f"Exporting volume: {volume_path}")
+        write_volume(volume_path, self.image_store, self.settings_parser.layer_sequence,
+                     self.layer_height, self.pixel_size)
+
 
     def _process_print_layers(self, slices_dir: str) -> None:
         """Process all print layers according to the sequence defined in settings"""
@@ -75,16 +119,21 @@ class PrintProcessor:
         # Optional: notify total layers found
         if self.on_status_update:
             self.on_status_update(f"Processing {total_layers} layers")
-        if self.on_progress_update:
-            self.on_progress_update(0, f"0/{total_layers} layers loaded")
-        
-        # Process each layer in sequence
-        for idx, layer_info in enumerate(layer_sequence, start=1):
-            # Update status for loading this layer
-            if self.on_status_update:
-                self.on_status_update(f"Loading layer {idx}/{total_layers}")
-            # Process the layer's images
-            layer_data = self._process_layer_info(slices_dir, layer_info)
+
+        # Decode every unique image file exactly once, in parallel, unless an
+        # up-to-date copy is already in the persistent cache
+        unique_files = self._collect_unique_files(layer_sequence)
+        if not self._load_cached_images(slices_dir, unique_files):
+            self._decode_unique_images(slices_dir, unique_files)
+            self._save_cached_images(slices_dir, unique_files)
+
+        self._build_slice_data()
+
+    def _build_slice_data(self) -> None:
+        """Assemble the layers; they only reference the shared images in the store"""
+        self.slice_data = []
+        for layer_info in self.settings_parser.layer_sequence:
+            layer_data = self._process_layer_info(layer_info)
             if layer_data:
                 layer_data['sequence_index'] = layer_info.sequence_index
                 layer_data['layer_number'] = self._extract_layer_number(layer_info.images[0].image_file)
@@ -92,58 +141,110 @@ class PrintProcessor:
                     layer_data['duplicate_index'] = layer_info.duplicate_index
                 self.slice_data.append(layer_data)
 
-            # Update progress after processing this layer
-            if self.on_progress_update:
-                progress = int((idx / total_layers) * 100)
-                self.on_progress_update(progress, f"{idx}/{total_layers} layers loaded")
-
         if self.on_status_update:
             self.on_status_update(f"Processed {len(self.slice_data)} layers using {self.settings_parser.get_unique_images()} unique images")
 
     
-    def _process_layer_info(self, slices_dir: str, layer_info) -> Optional[Dict]:
+    def _collect_unique_files(self, layer_sequence: List[LayerInfo]) -> List[str]:
+        """Return every image file referenced by the sequence, once, in first-use order"""
+        unique_files = {}
+        for layer_info in layer_sequence:
+            for image_info in layer_info.images:
+                unique_files.setdefault(image_info.image_file, None)
+        return list(unique_files)
+
+    def _load_cached_images(self, slices_dir: str, image_files: List[str]) -> bool:
+        """Fill the image store from the persistent cache if it is still valid"""
+        if self.slice_cache is None:
+            return False
+        try:
+            loaded = self.slice_cache.load(self.directory_path, self.settings_path,
+                                           slices_dir, image_files, self.image_store)
+        except Exception as e:
+            if self.on_status_update:
+                self.on_status_update(f"Warning: Ignoring unreadable slice cache: {e}")
+            loaded = False
+        if loaded:
+            self.total_images = self.images_loaded = len(self.image_store.paths())
+            if self.on_progress_update:
+                self.on_progress_update(100, f"Loaded {self.total_images} images from cache")
+        return loaded
+
+    def _save_cached_images(self, slices_dir: str, image_files: List[str]) -> None:
+        """Write the decoded images to the persistent cache (failures are not fatal)"""
+        if self.slice_cache is None:
+            return
+        if self.on_status_update:
+            self.on_status_update("Writing slice cache")
+        try:
+            self.slice_cache.save(self.directory_path, self.settings_path,
+                                  slices_dir, image_files, self.image_store,
+                                  self.settings_parser.layer_sequence, self.layer_height, self.pixel_size)
+        except Exception as e:
+            if self.on_status_update:
+                self.on_status_update(f"Warning: Could not write slice cache: {e}")
+
+    def _decode_unique_images(self, slices_dir: str, image_files: List[str]) -> None:
+        """Decode each unique image file once, spreading the work across a thread pool"""
+        self.image_store.clear()
+
+        existing = []
+        for image_file in image_files:
+            full_path = os.path.join(slices_dir, image_file)
+            if os.path.exists(full_path):
+                existing.append(image_file)
+            elif self.on_status_update:
+                self.on_status_update(f"Warning: Image file not found: {full_path}")
+
+        # Progress is reported against unique images, since that is the work actually done
+        self.total_images = len(existing)
+        self.images_loaded = 0
+        if self.on_progress_update:
+            self.on_progress_update(0, f"0/{self.total_images} images loaded")
+
+        # Callbacks are only invoked from this (the calling) thread
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(decode_slice, os.path.join(slices_dir, image_file), self.image_store.packed): image_file
+                       for image_file in existing}
+            for future in as_completed(futures):
+                image_file = futures[future]
+                img_array, digest, levels = future.result()
+                self.image_store.add(image_file, img_array, digest, levels)
+
+                self.images_loaded += 1
+                if self.on_progress_update:
+                    progress = int((self.images_loaded / self.total_images) * 100)
+                    self.on_progress_update(progress, f"Loaded image {self.images_loaded}/{self.total_images}")
+
+    def _process_layer_info(self, layer_info) -> Optional[Dict]:
         """Process a single layer based on its LayerInfo"""
-        images = []
+        image_ids = []
         exposure_times = []
         image_types = []
         texture_data = []  # Initialize texture_data list to hold texture info for each image
 
         for image_info in layer_info.images:
-            full_path = os.path.join(slices_dir, image_info.image_file)
-            
-            if os.path.exists(full_path):
-                if self.on_status_update:
-                    self.on_status_update(f"Loading image: {image_info.image_file}")
-                img = Image.open(full_path)
-                img_array = np.array(img)
-                images.append(img_array)
-                exposure_times.append(image_info.exposure_time or 0.0)
-                image_types.append(image_info.image_type)
-                
-                # Create texture data entry for this image (assuming texture generation here)
-                texture_key = self.texture_cache.get_texture_key(img_array, True)  # Generate a texture key
-                texture_data.append({
-                    'img': img_array,
-                    'texture_key': texture_key,
-                    'image_type': image_info.image_type,
-                    'exposure_time': image_info.exposure_time
-                })
-
-                # Incremental progress update for images
-                if self.on_progress_update and hasattr(self, 'total_images'):
-                    self.images_loaded += 1
-                    progress = int((self.images_loaded / self.total_images) * 100)
-                    self.on_progress_update(progress, f"Loaded image {self.images_loaded}/{self.total_images}")
-            else:
-                if self.on_status_update:
-                    self.on_status_update(f"Warning: Image file not found: {full_path}")
+            image_id = self.image_store.id_for_path(image_info.image_file)
+            if image_id is None:
+                # Missing files were already reported while decoding
                 continue
+
+            image_ids.append(image_id)
+            exposure_times.append(image_info.exposure_time or 0.0)
+            image_types.append(image_info.image_type)
+
+            texture_data.append({
+                'image_id': image_id,
+                'image_type': image_info.image_type,
+                # Same value as exposure_times, so images without one can still be toggled
+                'exposure_time': image_info.exposure_time or 0.0
+            })
                 
-        if not images:
+        if not image_ids:
             return None
             
         return {
-            'images': images,
+            'image_ids': image_ids,
             'exposure_times': exposure_times,
             'image_types': image_types,
             'texture_data': texture_data  # Add texture data here
@@ -167,8 +268,8 @@ class PrintProcessor:
         if not self.slice_data:
             return None
             
-        height, width = self.slice_data[0]['images'][0].shape
-        total_exposures = sum(len(layer['images']) for layer in self.slice_data)
+        height, width = self.image_store.shape(self.slice_data[0]['image_ids'][0])
+        total_exposures = sum(len(layer['image_ids']) for layer in self.slice_data)
         unique_images = self.settings_parser.get_unique_images()
         total_layers = self.settings_parser.get_total_layers()
         
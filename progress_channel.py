@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import deque
+
+
+class ProgressChannel:
+    """Collects status and progress reported from any thread for a UI to poll.
+
+    Posting only stores the latest values under a lock, so workers can report
+    every single item; the UI reads one coalesced update at its own refresh
+    rate. Rate and ETA are estimated from the progress values posted over the
+    last `window_seconds`.
+
+    `status` and `progress` match PrintProcessor's on_status_update and
+    on_progress_update callbacks.
+    """
+    def __init__(self, window_seconds=5.0):
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._message = None
+        self._value = 0
+        self._samples = deque()     # (time, progress value)
+        self._version = 0
+        self._polled_version = 0
+
+    def status(self, message):
+        with self._lock:
+            self._message = message
+            self._version += 1
+
+    def progress(self, value, message=None):
+        now = time.monotonic()
+        with self._lock:
+            if value < self._value:
+                # A new phase restarted the progress
+                self._samples.clear()
+            self._value = value
+            if message:
+                self._message = message
+            self._samples.append((now, value))
+            while len(self._samples) > 2 and self._samples[0][0] < now - self.window_seconds:
+                self._samples.popleft()
+            self._version += 1
+
+    def poll(self):
+        """Return (message, value, rate in %/s, ETA in s) if anything was posted since the last poll, else None.
+
+        Rate and ETA are None until there is enough progress to estimate them.
+        """
+        with self._lock:
+            if self._version == self._polled_version:
+                return None
+            self._polled_version = self._version
+            rate = eta = None
+            if len(self._samples) >= 2:
+                (t0, v0), (t1, v1) = self._samples[0], self._samples[-1]
+                if t1 > t0 and v1 > v0:
+                    rate = (v1 - v0) / (t1 - t0)
+                    eta = (100 - v1) / rate
+            return self._message, self._value, rate, eta
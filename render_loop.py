@@ -0,0 +1,134 @@
+import time
+from collections import deque
+
+from direct.gui.OnscreenText import OnscreenText
+from panda3d.core import TextNode
+
+import viewer_config
+
+
+def display_refresh_rate(base, fallback=60):
+    """Return the refresh rate of the current display mode, or `fallback` if the pipe does not report it."""
+    info = base.pipe.getDisplayInformation() if base.pipe is not None else None
+    if info is not None:
+        index = info.getCurrentDisplayModeIndex()
+        if 0 <= index < info.getTotalDisplayModes():
+            rate = info.getDisplayModeRefreshRate(index)
+            if rate > 0:
+                return rate
+    return fallback
+
+
+class RenderLoop:
+    """Steps Panda3D from the Tk event loop at a steady frame rate.
+
+    Each tick is scheduled from the previous tick's start rather than its end,
+    so a slow frame or Tk callback does not lower the rate, and missed frames
+    are dropped instead of caught up. While the viewer reports nothing changed
+    (see Viewer3D.needs_frame), frames are only stepped at the idle rate.
+
+    `target_fps` defaults to the display's refresh rate (60 if it is unknown).
+    With `on_demand`, idle steps also stop drawing: the window is deactivated
+    so tasks and input still run but nothing is rendered until a change.
+    """
+    def __init__(self, tk_root, base, viewer, target_fps=None, idle_fps=20, on_demand=False):
+        self.tk_root = tk_root
+        self.base = base
+        self.viewer = viewer
+        self.frame_interval = 1.0 / (target_fps or display_refresh_rate(base))
+        self.idle_interval = 1.0 / idle_fps
+        self.on_demand = on_demand
+        self.rendering = True
+        self.frames = deque()       # (start time, step seconds) of the frames in the last second
+        self.skipped = 0            # ticks skipped because nothing changed
+        self.overlay = None
+        self._overlay_due = 0.0
+        self._next_tick = None
+        self._last_step = 0.0
+        self._after_id = None
+        base.accept("f", self.toggle_overlay)
+        if viewer_config.SHOW_FPS_OVERLAY:
+            self.toggle_overlay()
+
+    def start(self):
+        self._next_tick = time.perf_counter()
+        self._tick()
+
+    def stop(self):
+        if self._after_id is not None:
+            self.tk_root.after_cancel(self._after_id)
+            self._after_id = None
+        self._set_rendering(True)
+
+    def _set_rendering(self, on):
+        if on != self.rendering and self.base.win is not None:
+            self.rendering = on
+            self.base.win.setActive(on)
+
+    def toggle_overlay(self):
+        """Show or hide the frame rate meter, the frame time statistics and the texture cache and atlas use."""
+        if self.overlay is None:
+            self.base.setFrameRateMeter(True)
+            self.overlay = OnscreenText("", parent=self.base.a2dBottomLeft, pos=viewer_config.FPS_OVERLAY_POS,
+                                        scale=viewer_config.FPS_OVERLAY_SCALE, align=TextNode.ALeft,
+                                        fg=(1, 1, 1, 1), mayChange=True)
+            self._overlay_due = 0.0
+        else:
+            self.base.setFrameRateMeter(False)
+            self.overlay.destroy()
+            self.overlay = None
+        self.viewer.mark_dirty()
+
+    def _tick(self):
+        start = time.perf_counter()
+        interval = self.frame_interval
+        if self.viewer.needs_frame():
+            self._set_rendering(True)
+            self._step(start)
+        elif start - self._last_step >= self.idle_interval:
+            if self.on_demand:
+                # The last frame already shows the current state: keep polling without drawing
+                self._set_rendering(False)
+                interval = self.idle_interval
+            self._step(start)
+        else:
+            self.skipped += 1
+        while self.frames and self.frames[0][0] < start - 1.0:
+            self.frames.popleft()
+        if self.overlay is not None and start >= self._overlay_due:
+            # The overlay text refreshes on its own interval, not every frame
+            self._overlay_due = start + viewer_config.FPS_OVERLAY_INTERVAL_MS / 1000
+            self._update_overlay()
+
+        self._next_tick += interval
+        now = time.perf_counter()
+        if self._next_tick < now:
+            # Behind schedule: drop the missed frames rather than stepping them back to back
+            self._next_tick = now
+        # Always yield at least 1 ms so Tk can handle its own events
+        self._after_id = self.tk_root.after(max(1, int((self._next_tick - now) * 1000)), self._tick)
+
+    def _step(self, start):
+        self.base.taskMgr.step()
+        self._last_step = start
+        if self.rendering:
+            self.frames.append((start, time.perf_counter() - start))
+
+    def _update_overlay(self):
+        times = [step for _, step in self.frames]
+        if times:
+            text = (f"{len(times)} frames/s  step {1000 * sum(times) / len(times):.1f} ms avg, "
+                    f"{1000 * max(times):.1f} ms max  ({self.skipped} idle ticks skipped)")
+        else:
+            text = f"idle ({self.skipped} ticks skipped)"
+        cache = self.viewer.texture_cache.stats()
+        text += (f"\ntexture cache: {cache['entries']} entries, {cache['bytes'] / (1024 * 1024):.1f} MB cached, "
+                 f"{cache['hits']} hits, {cache['misses']} misses, {cache['evictions']} evictions")
+        atlases = self.viewer.atlases
+        if atlases:
+            text += "\ntexture atlases: " + ", ".join(
+                f"level {level} {len(atlas)} slices in {len(atlas.pages)} pages ({atlas.nbytes() / (1024 * 1024):.1f} MB)"
+                for level, atlas in sorted(atlases.items()))
+        self.overlay.setText(text)
+        # Make sure the new text gets drawn even when the scene is idle
+        self.viewer.mark_dirty()
@@ -0,0 +1,195 @@
+import numpy as np
+from panda3d.core import Vec3
+
+from slice_store import COARSEST_LEVEL
+
+
+class ResidencyManager:
+    """Decides which layer textures deserve GPU memory in the card render mode.
+
+    Layers outside the view frustum, or behind enough nearly opaque layers that
+    almost no light reaches them, are dropped to the coarsest pyramid level. If
+    the remaining textures still exceed the VRAM budget, the layers smallest on
+    screen are coarsened first. Cached textures no shown layer needs any more
+    are released from the GPU (they stay in RAM and re-upload on demand).
+    """
+    def __init__(self, viewer, budget_bytes=None, occlusion_cutoff=0.01):
+        self.viewer = viewer
+        self.budget_bytes = budget_bytes
+        self.occlusion_cutoff = occlusion_cutoff
+        self._cards = None          # per-card arrays of the loaded print, built on first use
+        self._needed = set()        # (image_id, level) textures the shown layers use
+        self.resident_bytes = 0
+
+    def reset(self):
+        self._cards = None
+        self._needed = set()
+        self.resident_bytes = 0
+
+    def view_key(self):
+        """State besides the camera that changes which layers are visible."""
+        v = self.viewer
+        return (v.layer_opacity, v.show_positive, v.void_highlight, v.void_only,
+                frozenset(v.enabled_types), frozenset(v.enabled_exposures))
+
+    def _card_table(self):
+        """Return per-card arrays for the loaded print; they only change with a new load.
+
+        Cards are in layer order: 'layer' is the layer index (seq - 1), 'image' an
+        index into 'image_ids', 'fill' the image's filled fraction and 'texels' the
+        (level, image) texture sizes.
+        """
+        if self._cards is None:
+            v = self.viewer
+            layer, images, types, exposures = [], [], [], []
+            for index, data in enumerate(v.slice_data):
+                for td in data['texture_data']:
+                    layer.append(index)
+                    images.append(td['image_id'])
+                    types.append(td['image_type'])
+                    exposures.append(td.get('exposure_time'))
+            image_ids, image = np.unique(np.array(images, dtype=np.int64), return_inverse=True)
+            type_names, type_code = np.unique(np.array(types, dtype=object).astype(str), return_inverse=True)
+            fill = np.array([float(v.image_store.get_mask(image_id, COARSEST_LEVEL).mean())
+                             for image_id in image_ids.tolist()])
+            texels = np.array([[np.prod(v.image_store.shape(image_id, level)) for image_id in image_ids.tolist()]
+                               for level in range(COARSEST_LEVEL + 1)], dtype=np.int64)
+            self._cards = {'layer': np.array(layer, dtype=np.int64), 'image': image,
+                           'image_ids': image_ids, 'fill': fill[image], 'texels': texels,
+                           'type_names': type_names, 'type_code': type_code,
+                           'exposure': np.array(exposures, dtype=np.float64)}
+        return self._cards
+
+    def in_frustum(self, seqs, spacing, scale, aspect):
+        """Test every layer's bounding sphere against the lens frustum in one numpy pass."""
+        v = self.viewer
+        bounds = v.base.camLens.makeBounds()
+        bounds.xform(v.base.camera.getMat(v.root))
+        # Frustum planes in root space; their normals point out of the frustum
+        planes = np.array([list(bounds.getPlane(i)) for i in range(bounds.getNumPlanes())])
+        radius = scale * np.hypot(aspect, 1.0) / 2
+        # Layer centers are at (0, -seq * spacing, 0) in root space
+        ys = -np.asarray(seqs, dtype=np.float64) * spacing
+        distance = ys[:, None] * planes[:, 1] + planes[:, 3]
+        return ~(distance > radius).any(axis=1)
+
+    def _occluded(self, seqs, dist, in_view):
+        """Mark layers whose light is almost entirely blocked by nearer layers."""
+        v = self.viewer
+        occluded = np.zeros(len(seqs), dtype=bool)
+        # Stacked cards only cover each other when viewed roughly along the stack axis
+        view_dir = v.root.getRelativeVector(v.base.camera, Vec3(0, 1, 0))
+        view_dir.normalize()
+        if abs(view_dir.getY()) < 0.5 or v.layer_opacity <= 0:
+            return occluded
+        cards = self._card_table()
+        enabled = (np.isin(cards['type_names'], list(v.enabled_types))[cards['type_code']]
+                   & np.isin(cards['exposure'], list(v.enabled_exposures)))
+        # Fraction of each layer's area its shown cards cover (empty pixels in negative/void modes)
+        drawn_filled = v.show_positive and not (v.void_highlight or v.void_only)
+        covered = cards['fill'] if drawn_filled else 1.0 - cards['fill']
+        coverage = np.zeros(len(v.slice_data))
+        layer = cards['layer'][enabled]
+        if len(layer):
+            # Cards are in layer order, so each layer's enabled cards are one run
+            layers, starts = np.unique(layer, return_index=True)
+            coverage[layers] = np.maximum.reduceat(covered[enabled], starts)
+        transmittance = 1.0 - np.clip(v.layer_opacity * coverage[seqs - 1], 0.0, 1.0)
+        order = np.argsort(dist)
+        order = order[in_view[order]]
+        # Light reaching each layer through every nearer shown layer
+        reaching = np.concatenate(([1.0], np.cumprod(transmittance[order])[:-1]))
+        occluded[order] = reaching < self.occlusion_cutoff
+        return occluded
+
+    def adjust(self, seqs, levels, dist):
+        """Return the levels to apply to the shown layers `seqs`, given their LOD levels."""
+        v = self.viewer
+        if not len(seqs):
+            return levels
+        seqs = np.asarray(seqs, dtype=np.int64)
+        levels = np.array(levels)
+        height, width = v.image_store.shape(v.slice_data[0]['image_ids'][0])
+        spacing, scale = v._layer_geometry(height, width)
+
+        in_view = self.in_frustum(seqs, spacing, scale, width / height)
+        hidden = ~in_view | self._occluded(seqs, dist, in_view)
+        levels[hidden] = COARSEST_LEVEL
+
+        # Cards of the shown layers, as indices into `seqs`
+        cards = self._card_table()
+        position = np.full(len(v.slice_data), -1)
+        position[seqs - 1] = np.arange(len(seqs))
+        card_layer = position[cards['layer']]
+        shown = card_layer >= 0
+        card_layer, card_image = card_layer[shown], cards['image'][shown]
+        # Bytes of every (level, image) texture; atlas pages are shared and always resident
+        texture_bytes = cards['texels'] * (1 if v.use_mask_shader else 4)
+        texture_bytes[[level for level in v.atlases if level <= COARSEST_LEVEL]] = 0
+
+        refs, total = self._references(levels, card_layer, card_image, texture_bytes)
+        if self.budget_bytes is not None and total > self.budget_bytes:
+            levels = self._coarsen(levels, dist, card_layer, card_image, texture_bytes)
+            refs, total = self._references(levels, card_layer, card_image, texture_bytes)
+        self.resident_bytes = int(total)
+        image_ids = cards['image_ids']
+        self._needed = {(int(image_ids[image]), int(level)) for level, image in zip(*np.nonzero(refs))}
+        return levels
+
+    def _references(self, levels, card_layer, card_image, texture_bytes):
+        """Return the (level, image) reference counts of the shown cards and their total bytes."""
+        refs = np.bincount(levels[card_layer] * texture_bytes.shape[1] + card_image,
+                           minlength=texture_bytes.size).reshape(texture_bytes.shape)
+        return refs, texture_bytes[refs > 0].sum()
+
+    def _coarsen(self, levels, dist, card_layer, card_image, texture_bytes):
+        """Coarsen the layers farthest away (smallest on screen) until the textures fit the budget.
+
+        Layers are taken farthest first and each is coarsened to the coarsest level
+        before the next, stopping as soon as the textures fit. The totals after each
+        whole layer come from one pass over the cards; only the layer the budget is
+        reached in is stepped level by level.
+        """
+        images = texture_bytes.shape[1]
+        order = np.argsort(-dist)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        card_rank = rank[card_layer]
+        card_level = levels[card_layer]
+        # total[k]: bytes with the k farthest layers at the coarsest level
+        delta = np.zeros(len(order) + 1)
+        finer = card_level < COARSEST_LEVEL
+        # A finer texture goes once the last layer using it is coarsened ...
+        keys = card_level[finer] * images + card_image[finer]
+        last_rank = np.full(texture_bytes.size, -1)
+        np.maximum.at(last_rank, keys, card_rank[finer])
+        used = last_rank >= 0
+        np.add.at(delta, last_rank[used] + 1, -texture_bytes.ravel()[used])
+        # ... and a coarsest one arrives with the first layer coarsened onto it
+        coarse_refs = np.bincount(card_image[~finer], minlength=images)
+        first_rank = np.full(images, len(order))
+        np.minimum.at(first_rank, card_image[finer], card_rank[finer])
+        arrives = (coarse_refs == 0) & (first_rank < len(order))
+        np.add.at(delta, first_rank[arrives] + 1, texture_bytes[COARSEST_LEVEL, arrives])
+        _, total = self._references(levels, card_layer, card_image, texture_bytes)
+        totals = total + np.cumsum(delta)
+
+        fits = np.flatnonzero(totals <= self.budget_bytes)
+        levels = levels.copy()
+        if not len(fits):
+            levels[:] = COARSEST_LEVEL
+            return levels
+        # The budget is reached while coarsening the layer of rank fits[0] - 1
+        levels[order[:fits[0] - 1]] = COARSEST_LEVEL
+        last = order[fits[0] - 1]
+        while levels[last] < COARSEST_LEVEL:
+            levels[last] += 1
+            if self._references(levels, card_layer, card_image, texture_bytes)[1] <= self.budget_bytes:
+                break
+        return levels
+
+    def release_unused(self):
+        """Free the GPU copies of cached textures no shown layer needs."""
+        v = self.viewer
+        keep = {v._texture_key(image_id, level) for image_id, level in self._needed}
+        return v.texture_cache.release(keep)
@@ -0,0 +1,159 @@
+from panda3d.core import Shader
+
+# Single-channel slice masks are colored on the GPU. Inputs:
+#   p3d_Texture0   - mask texture, red channel is 1 where the slice has pixels
+#                    (p3d_TextureMatrix selects the tile when it is an atlas page)
+#   exposure_color - color of the card's exposure (set per card)
+#   layer_opacity  - global layer opacity (set on the scene root)
+#   mask_mode      - texture_builder.MODE_* value (set on the scene root)
+#   light_scale    - the scene lights' ambient plus diffuse term for the cards, which all
+#                    face the same way (set on the scene root; see Viewer3D._scene_light_scale)
+# Changing any of these is a uniform update; no texture is rebuilt or re-uploaded.
+
+# Shared by every mask shader: color a sample of the mask for the current mode
+MASK_COLOR_FUNCTION = """
+vec4 mask_color(float filled, vec3 color, float opacity, float mode) {
+    vec3 rgb = vec3(1.0);
+    float alpha = filled;                       // positive: draw filled pixels
+    if (mode > 0.5) {
+        alpha = 1.0 - filled;                   // negative and void modes: draw empty pixels
+        if (mode > 1.5 && mode < 2.5) {
+            rgb = vec3(1.0, 0.0, 0.0);          // void highlight (matches the RGBA textures)
+        }
+    }
+    return vec4(rgb * color, alpha * opacity);
+}
+"""
+
+MASK_VERTEX_SHADER = """
+#version 120
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_TextureMatrix;
+attribute vec4 p3d_Vertex;
+attribute vec2 p3d_MultiTexCoord0;
+varying vec2 texcoord;
+
+void main() {
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+    // Identity unless the card samples a tile of a texture atlas page
+    texcoord = (p3d_TextureMatrix * vec4(p3d_MultiTexCoord0, 0.0, 1.0)).xy;
+}
+"""
+
+MASK_FRAGMENT_SHADER = """
+#version 120
+
+uniform sampler2D p3d_Texture0;
+uniform vec4 exposure_color;
+uniform float layer_opacity;
+uniform float mask_mode;
+uniform vec3 light_scale;
+varying vec2 texcoord;
+""" + MASK_COLOR_FUNCTION + """
+void main() {
+    float filled = texture2D(p3d_Texture0, texcoord).r;
+    gl_FragColor = mask_color(filled, exposure_color.rgb * light_scale, layer_opacity, mask_mode);
+}
+"""
+
+# Volume mode: one instanced card per slice image, a chunk's pages in a 2D texture array.
+#   volume_pages   - 2D texture array, one page per unique slice in the chunk
+#   instance_table - per instance: (page, y offset in card space, visible, unused)
+#   instance_color - per instance exposure color
+VOLUME_VERTEX_SHADER = """
+#version 140
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform sampler2D instance_table;
+uniform sampler2D instance_color;
+in vec4 p3d_Vertex;
+in vec2 p3d_MultiTexCoord0;
+out vec3 texcoord;
+out vec3 color;
+
+void main() {
+    int width = textureSize(instance_table, 0).x;
+    ivec2 cell = ivec2(gl_InstanceID % width, gl_InstanceID / width);
+    vec4 inst = texelFetch(instance_table, cell, 0);
+    color = texelFetch(instance_color, cell, 0).rgb;
+    texcoord = vec3(p3d_MultiTexCoord0, inst.x);
+    if (inst.z < 0.5) {
+        gl_Position = vec4(2.0, 2.0, 2.0, 1.0);   // hidden: outside the clip volume
+        return;
+    }
+    vec4 vertex = p3d_Vertex;
+    vertex.y += inst.y;
+    gl_Position = p3d_ModelViewProjectionMatrix * vertex;
+}
+"""
+
+VOLUME_FRAGMENT_SHADER = """
+#version 140
+
+uniform sampler2DArray volume_pages;
+uniform float layer_opacity;
+uniform float mask_mode;
+uniform vec3 light_scale;
+in vec3 texcoord;
+in vec3 color;
+out vec4 p3d_FragColor;
+""" + MASK_COLOR_FUNCTION + """
+void main() {
+    float filled = texture(volume_pages, texcoord).r;
+    p3d_FragColor = mask_color(filled, color * light_scale, layer_opacity, mask_mode);
+}
+"""
+
+# Batched mode: each layer chunk is one Geom over a per-chunk 2D texture array.
+#   chunk_pages - 2D texture array, one page per unique slice in the chunk
+#   p3d_Color   - per-vertex exposure color
+#   texcoord.z  - page of the card's slice
+BATCH_VERTEX_SHADER = """
+#version 130
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+in vec4 p3d_Vertex;
+in vec4 p3d_Color;
+in vec3 p3d_MultiTexCoord0;
+out vec3 texcoord;
+out vec3 color;
+
+void main() {
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+    texcoord = p3d_MultiTexCoord0;
+    color = p3d_Color.rgb;
+}
+"""
+
+BATCH_FRAGMENT_SHADER = """
+#version 130
+
+uniform sampler2DArray chunk_pages;
+uniform float layer_opacity;
+uniform float mask_mode;
+uniform vec3 light_scale;
+in vec3 texcoord;
+in vec3 color;
+out vec4 p3d_FragColor;
+""" + MASK_COLOR_FUNCTION + """
+void main() {
+    float filled = texture(chunk_pages, texcoord).r;
+    p3d_FragColor = mask_color(filled, color * light_scale, layer_opacity, mask_mode);
+}
+"""
+
+
+def make_mask_shader():
+    """Return the shader that colors single-channel slice masks."""
+    return Shader.make(Shader.SL_GLSL, vertex=MASK_VERTEX_SHADER, fragment=MASK_FRAGMENT_SHADER)
+
+
+def make_volume_shader():
+    """Return the instanced texture-array shader used by the volume render mode."""
+    return Shader.make(Shader.SL_GLSL, vertex=VOLUME_VERTEX_SHADER, fragment=VOLUME_FRAGMENT_SHADER)
+
+
+def make_batch_shader():
+    """Return the shader used by the batched render mode's layer chunks."""
+    return Shader.make(Shader.SL_GLSL, vertex=BATCH_VERTEX_SHADER, fragment=BATCH_FRAGMENT_SHADER)
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import sys
+from typing import Dict, List, Optional, Sequence
+
+from print_settings_parser import LayerInfo
+from slice_store import SliceStore
+from volume_file import VOLUME_EXTENSION, read_volume, write_volume
+
+CACHE_VERSION = 3
+INDEX_FILE = "index.json"
+VOLUME_FILE = "slices" + VOLUME_EXTENSION
+
+
+def default_cache_dir() -> str:
+    """Return the per-user cache directory for decoded slices"""
+    if sys.platform.startswith("win"):
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "3d_slice_viewer")
+
+
+def _fingerprint(path: str) -> Optional[List[int]]:
+    """Return [mtime_ns, size] for a file, or None if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class SliceCache:
+    """Persistent on-disk cache of decoded slices, one entry per print directory.
+
+    Each entry is a volume file (see volume_file.py) with every unique slice as
+    packed bits, plus a JSON index holding the mtime/size of every source file.
+    A cached entry is only used when all of those fingerprints still match, and it
+    is memory-mapped rather than read, so reopening a large print is nearly free.
+    """
+    def __init__(self, cache_dir: Optional[str] = None):
+        self.cache_dir = cache_dir or default_cache_dir()
+
+    def _entry_dir(self, print_dir: str) -> str:
+        key = os.path.normcase(os.path.abspath(print_dir))
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+    def _fingerprints(self, settings_path: str, slices_dir: str, image_files: List[str]) -> Dict:
+        return {
+            'settings': _fingerprint(settings_path),
+            'files': {f: _fingerprint(os.path.join(slices_dir, f)) for f in image_files},
+        }
+
+    def load(self, print_dir: str, settings_path: str, slices_dir: str,
+             image_files: List[str], store: SliceStore) -> bool:
+        """Fill `store` from the cache; return False if there is no valid entry"""
+        entry_dir = self._entry_dir(print_dir)
+        try:
+            with open(os.path.join(entry_dir, INDEX_FILE), 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if index.get('version') != CACHE_VERSION:
+            return False
+        if index.get('fingerprints') != self._fingerprints(settings_path, slices_dir, image_files):
+            return False
+
+        try:
+            volume = read_volume(os.path.join(entry_dir, VOLUME_FILE))
+        except (OSError, ValueError):
+            return False
+        # Zero-copy views into the memory-mapped volume
+        volume.fill_store(store)
+        return True
+
+    def save(self, print_dir: str, settings_path: str, slices_dir: str,
+             image_files: List[str], store: SliceStore, layer_sequence: Sequence[LayerInfo] = (),
+             layer_height: float = 10.0, pixel_size: float = 7.6) -> None:
+        """Write the contents of `store` as the cache entry for a print directory"""
+        entry_dir = self._entry_dir(print_dir)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        index = {
+            'version': CACHE_VERSION,
+            'print_dir': os.path.abspath(print_dir),
+            'fingerprints': self._fingerprints(settings_path, slices_dir, image_files),
+        }
+
+        # Write the volume first and the index last, each atomically, so a partially
+        # written entry never validates
+        index_path = os.path.join(entry_dir, INDEX_FILE)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        volume_tmp = os.path.join(entry_dir, VOLUME_FILE + ".tmp")
+        write_volume(volume_tmp, store, layer_sequence, layer_height, pixel_size)
+        os.replace(volume_tmp, os.path.join(entry_dir, VOLUME_FILE))
+        index_tmp = index_path + ".tmp"
+        with open(index_tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(index_tmp, index_path)
@@ -0,0 +1,216 @@
+import hashlib
+import threading
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Resolution pyramid kept for every slice: level 0 is full size, each further
+# level is a quarter of the previous one (1/1, 1/4, 1/16)
+PYRAMID_SCALES = (1.0, 0.25, 0.0625)
+PYRAMID_STEP = 0.25
+COARSEST_LEVEL = len(PYRAMID_SCALES) - 1
+
+
+def content_digest(array: np.ndarray) -> str:
+    """Hash an array's contents (plus shape and dtype) into a short hex digest"""
+    array = np.ascontiguousarray(array)
+    m = hashlib.blake2b(digest_size=16)
+    m.update(str((array.shape, array.dtype.str)).encode())
+    m.update(memoryview(array).cast('B'))
+    return m.hexdigest()
+
+
+class PackedMask:
+    """Binary slice mask stored 8 pixels per byte.
+
+    Slices are only ever tested for `img > 0`, so packing them with np.packbits is
+    lossless for the viewer and cuts resident memory by about 8x.
+    """
+    __slots__ = ('bits', 'shape')
+
+    def __init__(self, bits: np.ndarray, shape):
+        self.bits = bits
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> 'PackedMask':
+        """Pack the non-zero pixels of a decoded slice"""
+        mask = array > 0
+        if mask.ndim == 3:
+            mask = mask.any(axis=2)
+        return cls(np.packbits(mask, axis=1), mask.shape)
+
+    def unpack(self) -> np.ndarray:
+        """Unpack into a uint8 array of 0/255, like a decoded slice"""
+        array = np.unpackbits(self.bits, axis=1, count=self.shape[1])
+        array *= 255
+        return array
+
+    def unpack_mask(self) -> np.ndarray:
+        """Unpack into a boolean array (True where the slice has pixels)"""
+        return np.unpackbits(self.bits, axis=1, count=self.shape[1]).view(bool)
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+
+def downsample_mask(img: np.ndarray, scale: float) -> np.ndarray:
+    """Resize a 0/255 slice with area averaging and return the mask of non-zero pixels.
+
+    Any partially covered output pixel stays set, so thin features survive.
+    """
+    small = cv2.resize(img, (max(1, int(img.shape[1]*scale)), max(1, int(img.shape[0]*scale))),
+                       interpolation=cv2.INTER_AREA)
+    return small > 0
+
+
+def build_pyramid(array: np.ndarray) -> List[np.ndarray]:
+    """Return the reduced pyramid levels (1/4, 1/16, ...) of a slice as 0/255 uint8 arrays"""
+    level = array
+    if level.ndim == 3:
+        level = level.any(axis=2).view(np.uint8) * np.uint8(255)
+    levels = []
+    for _ in PYRAMID_SCALES[1:]:
+        level = downsample_mask(level, PYRAMID_STEP).view(np.uint8) * np.uint8(255)
+        levels.append(level)
+    return levels
+
+
+def decode_slice(full_path: str, packed: bool = False):
+    """Decode a slice image (optionally packing it), hash it and build its pyramid.
+
+    Runs on a worker thread, so the full-size array of a packed slice never
+    outlives this call.
+    """
+    with Image.open(full_path) as img:
+        array = np.array(img)
+    levels = build_pyramid(array)
+    if packed:
+        mask = PackedMask.from_array(array)
+        return mask, content_digest(mask.bits), [PackedMask.from_array(level) for level in levels]
+    return array, content_digest(array), levels
+
+
+class SliceStore:
+    """Central store holding exactly one array per unique slice image.
+
+    Images are looked up by file path or by content digest, so identical images
+    stored under different file names still share memory. Layers only keep the
+    small integer handle returned by `add`.
+
+    With `packed=True` images are held as PackedMask and only unpacked when a
+    caller asks for the pixels (i.e. when a texture is built).
+
+    Every image also carries the reduced levels of its resolution pyramid
+    (see PYRAMID_SCALES); `level` arguments select one, 0 being full size.
+    """
+    def __init__(self, packed: bool = False):
+        self.packed = packed
+        self._arrays = []
+        self._levels = []
+        self._digests = []
+        self._by_path = {}
+        self._by_digest = {}
+        self._lock = threading.Lock()
+
+    def _convert(self, array):
+        if self.packed and not isinstance(array, PackedMask):
+            return PackedMask.from_array(array)
+        if not self.packed and isinstance(array, PackedMask):
+            return array.unpack()
+        return array
+
+    def add(self, path: str, array, digest: Optional[str] = None, levels=None) -> int:
+        """Store an image (if its content is new) and return its handle.
+
+        `levels` are its reduced pyramid levels; they are built on first use if omitted.
+        """
+        array = self._convert(array)
+        if digest is None:
+            digest = content_digest(array.bits if isinstance(array, PackedMask) else array)
+        with self._lock:
+            image_id = self._by_digest.get(digest)
+            if image_id is None:
+                image_id = len(self._arrays)
+                self._arrays.append(array)
+                self._levels.append([self._convert(level) for level in levels] if levels else None)
+                self._digests.append(digest)
+                self._by_digest[digest] = image_id
+            self._by_path[path] = image_id
+            return image_id
+
+    def id_for_path(self, path: str) -> Optional[int]:
+        """Return the handle stored for a file path, or None if it was never added"""
+        return self._by_path.get(path)
+
+    def levels(self, image_id: int) -> list:
+        """Return the stored reduced pyramid levels for a handle, building them if missing"""
+        levels = self._levels[image_id]
+        if levels is None:
+            levels = [self._convert(level) for level in build_pyramid(self.get(image_id))]
+            self._levels[image_id] = levels
+        return levels
+
+    def get_stored_level(self, image_id: int, level: int = 0):
+        """Return the stored object for one pyramid level without unpacking"""
+        if level == 0:
+            return self._arrays[image_id]
+        return self.levels(image_id)[level - 1]
+
+    def get(self, image_id: int, level: int = 0) -> np.ndarray:
+        """Return the pixels for a handle, unpacking packed masks on demand"""
+        array = self.get_stored_level(image_id, level)
+        if isinstance(array, PackedMask):
+            return array.unpack()
+        return array
+
+    def get_mask(self, image_id: int, level: int = 0) -> np.ndarray:
+        """Return a boolean array that is True where the image is non-zero"""
+        array = self.get_stored_level(image_id, level)
+        if isinstance(array, PackedMask):
+            return array.unpack_mask()
+        mask = array > 0
+        if mask.ndim == 3:
+            mask = mask.any(axis=2)
+        return mask
+
+    def get_stored(self, image_id: int):
+        """Return the stored object for a handle (an ndarray or a PackedMask) without unpacking"""
+        return self._arrays[image_id]
+
+    def digest(self, image_id: int) -> str:
+        """Return the content digest for a handle"""
+        return self._digests[image_id]
+
+    def shape(self, image_id: int, level: int = 0):
+        """Return the (height, width) of the image for a handle"""
+        return self.get_stored_level(image_id, level).shape[:2]
+
+    def paths(self) -> Dict[str, int]:
+        """Return a copy of the path -> handle mapping"""
+        with self._lock:
+            return dict(self._by_path)
+
+    def ids(self) -> List[int]:
+        """Return every handle in the store"""
+        return list(range(len(self._arrays)))
+
+    @property
+    def nbytes(self) -> int:
+        """Total bytes held by the stored arrays, pyramid levels included"""
+        return (sum(a.nbytes for a in self._arrays)
+                + sum(level.nbytes for levels in self._levels if levels for level in levels))
+
+    def __len__(self) -> int:
+        return len(self._arrays)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._arrays.clear()
+            self._levels.clear()
+            self._digests.clear()
+            self._by_path.clear()
+            self._by_digest.clear()
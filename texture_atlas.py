@@ -0,0 +1,78 @@
+import numpy as np
+import cv2
+from panda3d.core import Texture, TransformState
+
+from texture_builder import make_texture
+
+# Empty border around every tile (edge pixels are replicated into it) so linear
+# filtering never samples a neighbouring slice
+GUTTER = 1
+
+
+class TextureAtlas:
+    """Packs low-resolution slice masks into a few large texture pages.
+
+    Tiles are laid out on a fixed grid sized for the largest slice. `pack` only
+    touches numpy buffers and can run on a worker thread; `upload` then creates
+    every page texture at once on the main thread.
+    """
+    def __init__(self, page_size=4096):
+        self.page_size = page_size
+        self.pages = []        # page Textures, filled by upload()
+        self.entries = {}      # image_id -> (page index, (u offset, v offset), (u scale, v scale))
+        self._buffers = []     # page buffers between pack() and upload()
+
+    def __contains__(self, image_id):
+        return bool(self.pages) and image_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def pack(self, image_ids, make_image):
+        """Build the page buffers; make_image(image_id) returns a (H, W) uint8 mask."""
+        images = {image_id: make_image(image_id) for image_id in image_ids}
+        if not images:
+            return
+        tile_h = max(img.shape[0] for img in images.values()) + 2 * GUTTER
+        tile_w = max(img.shape[1] for img in images.values()) + 2 * GUTTER
+        page_h = max(self.page_size, tile_h)
+        page_w = max(self.page_size, tile_w)
+        rows, cols = page_h // tile_h, page_w // tile_w
+        per_page = rows * cols
+
+        self.entries = {}
+        self._buffers = []
+        for n, (image_id, img) in enumerate(images.items()):
+            page, slot = divmod(n, per_page)
+            if page == len(self._buffers):
+                # Trim the last page to the rows it actually uses
+                used = min(per_page, len(images) - n)
+                self._buffers.append(np.zeros((-(-used // cols) * tile_h, page_w), dtype=np.uint8))
+            buffer = self._buffers[page]
+            y, x = (slot // cols) * tile_h, (slot % cols) * tile_w
+            h, w = img.shape
+            buffer[y:y + h + 2 * GUTTER, x:x + w + 2 * GUTTER] = cv2.copyMakeBorder(
+                img, GUTTER, GUTTER, GUTTER, GUTTER, cv2.BORDER_REPLICATE)
+            ph, pw = buffer.shape
+            self.entries[image_id] = (page,
+                                      ((x + GUTTER) / pw, (y + GUTTER) / ph),
+                                      (w / pw, h / ph))
+
+    def upload(self, prepared_objects=None, compress=False):
+        """Create the page textures, queueing them for upload together if given a GSG's prepared objects."""
+        self.pages = [make_texture(buffer, Texture.F_red, compress=compress) for buffer in self._buffers]
+        self._buffers = []
+        if prepared_objects is not None:
+            for tex in self.pages:
+                tex.prepare(prepared_objects)
+
+    def lookup(self, image_id):
+        """Return (page texture, texture transform) for an image, or None if it is not packed."""
+        entry = self.entries.get(image_id)
+        if entry is None or not self.pages:
+            return None
+        page, offset, scale = entry
+        return self.pages[page], TransformState.makePosRotateScale2d(offset, 0, scale)
+
+    def nbytes(self):
+        return sum(tex.getExpectedRamImageSize() for tex in self.pages)
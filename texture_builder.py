@@ -0,0 +1,98 @@
+import numpy as np
+from panda3d.core import Texture, SamplerState
+
+# Texture modes: which pixels of a slice are drawn, and in what color
+MODE_POSITIVE = 0        # filled pixels drawn white
+MODE_NEGATIVE = 1        # empty pixels drawn white
+MODE_VOID_HIGHLIGHT = 2  # empty pixels drawn in the highlight color, filled pixels hidden
+MODE_VOID_ONLY = 3       # empty pixels drawn white, filled pixels hidden
+
+# Pyramid level used for fast (low quality) textures (1/4 size, see slice_store.PYRAMID_SCALES)
+FAST_LEVEL = 1
+
+
+def _pack_rgba(*channels):
+    # Panda3D RAM images are stored in BGRA byte order
+    return np.array(channels, dtype=np.uint8).view(np.uint32)[0]
+
+
+# One lookup table per mode, indexed by the slice mask: [empty pixel, filled pixel].
+# Each entry is a whole pixel (4 bytes), so a texture is a single gather.
+# The void highlight bytes are (0, 0, 255) in BGRA order, i.e. red.
+_RGBA_LUTS = {
+    MODE_POSITIVE:       np.array([_pack_rgba(0, 0, 0, 0), _pack_rgba(255, 255, 255, 255)]),
+    MODE_NEGATIVE:       np.array([_pack_rgba(255, 255, 255, 255), _pack_rgba(0, 0, 0, 0)]),
+    MODE_VOID_HIGHLIGHT: np.array([_pack_rgba(0, 0, 255, 255), _pack_rgba(0, 0, 0, 0)]),
+    MODE_VOID_ONLY:      np.array([_pack_rgba(255, 255, 255, 255), _pack_rgba(0, 0, 0, 0)]),
+}
+
+
+def texture_mode(show_positive, void_highlight, void_only):
+    """Return the texture mode for the viewer's display flags (void modes take precedence)."""
+    if void_only:
+        return MODE_VOID_ONLY
+    if void_highlight:
+        return MODE_VOID_HIGHLIGHT
+    return MODE_POSITIVE if show_positive else MODE_NEGATIVE
+
+
+def build_rgba(mask, mode):
+    """Build the final RGBA (BGRA) buffer for a boolean slice mask in one vectorized pass.
+
+    Opacity is not baked in; it comes from the card's color scale.
+    """
+    lut = _RGBA_LUTS[mode]
+    rgba = lut[mask.view(np.uint8)]
+    return rgba.view(np.uint8).reshape(*mask.shape, 4)
+
+
+def build_mask_image(mask):
+    """Build a single-channel 0/255 buffer for a boolean slice mask (colored by the mask shader)."""
+    return mask.view(np.uint8) * np.uint8(255)
+
+
+def _min_filter(mipmap):
+    # GPU generated mipmaps take care of minification within a pyramid level
+    return SamplerState.FT_linear_mipmap_linear if mipmap else SamplerState.FT_linear
+
+
+def make_texture(buffer, fmt=Texture.F_rgba, compress=False, mipmap=False):
+    """Upload a (H, W) or (H, W, C) uint8 buffer into a new clamped, linearly filtered texture."""
+    tex = Texture("layer_tex")
+    tex.setup2dTexture(buffer.shape[1], buffer.shape[0], Texture.T_unsigned_byte, fmt)
+    tex.setWrapU(SamplerState.WM_clamp)
+    tex.setWrapV(SamplerState.WM_clamp)
+    tex.setMinfilter(_min_filter(mipmap))
+    tex.setMagfilter(SamplerState.FT_linear)
+    tex.setRamImage(np.ascontiguousarray(buffer))
+    if compress:
+        tex.setCompression(Texture.CMDefault)
+    return tex
+
+
+def make_texture_array(pages, compress=False, mipmap=False):
+    """Upload a (pages, H, W) uint8 stack of single-channel masks as a 2D texture array."""
+    tex = Texture("layer_pages")
+    tex.setup2dTextureArray(pages.shape[2], pages.shape[1], pages.shape[0],
+                            Texture.T_unsigned_byte, Texture.F_red)
+    tex.setWrapU(SamplerState.WM_clamp)
+    tex.setWrapV(SamplerState.WM_clamp)
+    tex.setMinfilter(_min_filter(mipmap))
+    tex.setMagfilter(SamplerState.FT_linear)
+    tex.setRamImage(np.ascontiguousarray(pages))
+    if compress:
+        tex.setCompression(Texture.CMDefault)
+    return tex
+
+
+def make_table_texture(rows, name="table"):
+    """Upload an (H, W, 4) float32 array of shader data as an unfiltered RGBA32F texture.
+
+    Values are given in RGBA order and swizzled into Panda3D's BGRA RAM layout.
+    """
+    tex = Texture(name)
+    tex.setup2dTexture(rows.shape[1], rows.shape[0], Texture.T_float, Texture.F_rgba32)
+    tex.setMinfilter(SamplerState.FT_nearest)
+    tex.setMagfilter(SamplerState.FT_nearest)
+    tex.setRamImage(np.ascontiguousarray(rows[..., [2, 1, 0, 3]], dtype=np.float32))
+    return tex
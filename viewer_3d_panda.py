@@ -5,13 +5,22 @@ from direct.gui.DirectGui import *
 from panda3d.core import (
     Point3, Vec3, Vec4, CardMaker, Texture, GeomVertexFormat, GeomVertexData,
     GeomVertexWriter, Geom, GeomTriangles, GeomNode, NodePath, WindowProperties,
-    Filename, TextNode, TransparencyAttrib, AmbientLight, DirectionalLight, SamplerState
+    Filename, TextNode, TransparencyAttrib, AmbientLight, DirectionalLight, TextureStage
 )
 from print_processor import PrintProcessor
+from slice_cache import SliceCache
+from texture_builder import FAST_LEVEL, build_mask_image, build_rgba, make_texture, texture_mode
+from slice_store import COARSEST_LEVEL, PYRAMID_SCALES
+from shaders import make_mask_shader
+from volume_renderer import VolumeRenderer
+from layer_batcher import LayerBatcher
+from texture_atlas import TextureAtlas
+from lod_manager import LODManager, level_for_ratio
+from residency_manager import ResidencyManager
 from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
 import threading
-import hashlib
-import cv2
+import time
 
 import viewer_config
 from viewer_config import lerp_color
@@ -20,23 +29,117 @@ from viewer_config import lerp_color
 EPSILON = 1e-5  # A very small value to prevent clipping
 
 class TextureCache:
-    def __init__(self):
-        self._cache = {}
+    """Thread-safe LRU cache of textures, bounded by the bytes of their RAM images."""
+    def __init__(self, budget_bytes=None):
+        self._cache = OrderedDict()   # key -> (texture, nbytes), least recently used first
         self._lock = threading.Lock()
-    def get_texture_key(self, img_data, show_positive):
-        m = hashlib.md5()
-        m.update(img_data.tobytes())
-        m.update(str(show_positive).encode())
-        return m.hexdigest()
+        self.budget_bytes = budget_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
     def get(self, key):
         with self._lock:
-            return self._cache.get(key)
-    def put(self, key, texture):
+            entry = self._cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    def __contains__(self, key):
         with self._lock:
-            self._cache[key] = texture
+            return key in self._cache
+    def put(self, key, texture, nbytes=None):
+        if nbytes is None:
+            nbytes = texture.getExpectedRamImageSize()
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._cache[key] = (texture, nbytes)
+            self.total_bytes += nbytes
+            # Evict least recently used textures, but always keep the newest one.
+            # Textures still applied to a card stay alive through the scene graph.
+            while (self.budget_bytes is not None and self.total_bytes > self.budget_bytes
+                   and len(self._cache) > 1):
+                _, (_, evicted_bytes) = self._cache.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+                self.evictions += 1
+    def release(self, keep):
+        """Free the GPU copies of cached textures whose keys are not in `keep`; return how many."""
+        with self._lock:
+            textures = [tex for key, (tex, _) in self._cache.items() if key not in keep]
+        released = 0
+        for tex in textures:
+            if tex.releaseAll():
+                released += 1
+        return released
     def clear(self):
         with self._lock:
             self._cache.clear()
+            self.total_bytes = 0
+    def stats(self):
+        """Return hit/miss/eviction counters and current memory use.
+
+        'bytes' counts cached entries only: an evicted texture still applied to a
+        card stays alive through the scene graph but is no longer counted.
+        """
+        with self._lock:
+            return {'entries': len(self._cache),
+                    'bytes': self.total_bytes,
+                    'budget_bytes': self.budget_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+def build_exposure_colors(exposure_times):
+    """
+    Assign a color to every exposure time, grouping exposure times within ±50ms.
+    Exposure times in the same group share a base color with light/dark variants.
+    Returns {exposure_time: (r, g, b)} with components in 0..1.
+    """
+    # Group exposure times within ±50 ms (max 3 per group)
+    groups = []
+    current_group = []
+    for exp in sorted(exposure_times):
+        if not current_group:
+            current_group = [exp]
+        elif exp - current_group[0] <= 50 and len(current_group) < 3:
+            current_group.append(exp)
+        else:
+            groups.append(current_group)
+            current_group = [exp]
+    if current_group:
+        groups.append(current_group)
+    # Assign colors to each exposure time based on its group
+    exposure_time_to_color = {}
+    color_list = viewer_config.EXPOSURE_COLORS
+    color_count = len(color_list)
+    white = Vec4(1.0, 1.0, 1.0, 1.0)
+    black = Vec4(0.0, 0.0, 0.0, 1.0)
+    for idx, group in enumerate(groups):
+        base_hex = color_list[idx % color_count]
+        # Convert base color from hex to Vec4 for calculations
+        r = int(base_hex[1:3], 16) / 255.0
+        g = int(base_hex[3:5], 16) / 255.0
+        b = int(base_hex[5:7], 16) / 255.0
+        base_color = Vec4(r, g, b, 1.0)
+        light_color = lerp_color(base_color, white, 0.5)
+        dark_color = lerp_color(base_color, black, 0.5)
+        if len(group) == 1:
+            # Single exposure uses the base color
+            shades = [base_color]
+        elif len(group) == 2:
+            # Two exposures: lighter shade for lower value, darker for higher value
+            shades = [light_color, dark_color]
+        else:
+            # Three exposures: low→light, mid→base, high→dark
+            shades = [light_color, base_color, dark_color]
+        for exp, color in zip(group, shades):
+            exposure_time_to_color[exp] = (color[0], color[1], color[2])
+    return exposure_time_to_color
+
 
 class Viewer3D:
     def __init__(self, base):
@@ -59,6 +162,7 @@ class Viewer3D:
         self.right_mouse_down = False
         self.last_x = self.last_y = 0
         self._pan_start_target = None
+        self._view_changed = True      # camera or pan moved since the last update
         self.setup_controls()
         # scene root
         self.root = self.base.render.attachNewNode("root")
@@ -79,23 +183,72 @@ class Viewer3D:
         self.base.render.setShaderAuto()
         # modes
         self.show_positive = True
-        self.high_quality = False
+        # "auto" picks a pyramid level from the on-screen size, "fast"/"quality" pin one
+        self.quality_mode = viewer_config.DEFAULT_QUALITY_MODE
+        self.texture_level = 0 if self.quality_mode == "quality" else FAST_LEVEL
         self.void_highlight = False
         self.void_only      = False
         # UI state
         self.visible_range = {'top': None, 'bottom': None}
+        self._range_dirty = False      # set_layer_range is applied once per frame
+        self._frame_dirty = True       # the next frame may differ from the last rendered one
+        self._applied_range = None     # (bottom, top) the layer cards currently reflect
+        self.layer_cards = {}          # seq -> [(card, texture data)]
+        self.shown_layers = set()      # seqs of the layers inside the visible range
+        self.card_groups = {}          # (exposure, image type) -> parent node with the shared card state
         # data
         self.slice_data = None
         self.total_layers = 0
         self.unique_layers = 0
         self.layer_height = None
+        self.image_store = None
+        # exposure -> (r, g, b), built once per load; Vec4s are rebuilt only on opacity change
+        self.exposure_colors = {}
+        self._exposure_color_vecs = {}
+        self._exposure_color_opacity = None
         # caches & pools
-        self.texture_cache = TextureCache()
+        self.texture_cache = TextureCache(viewer_config.TEXTURE_CACHE_BUDGET_MB * 1024 * 1024)
+        self.slice_cache = SliceCache(viewer_config.SLICE_CACHE_DIR) if viewer_config.SLICE_CACHE_ENABLED else None
         self.thread_pool = ThreadPoolExecutor(max_workers=4)
         self.BATCH_SIZE = 10
+        self._print_job = None         # (processor, future, on_done) while a print is read in the background
+        self.loading_batches = []      # futures of the layer batches being prepared
+        self._ready_layers = deque()   # prepared layer data waiting to be attached to the scene
+        self._pending_layers = set()   # seqs not yet submitted for loading
+        self._atlas_moves = deque()    # seqs created on standalone textures, moving onto a new atlas
+        self.load_level = FAST_LEVEL   # pyramid level cards are created at
         self.layer_opacity = 0.5
+        # Color single-channel mask textures on the GPU when shaders are available;
+        # otherwise fall back to per-mode RGBA textures
+        gsg = self.base.win.getGsg() if self.base.win else None
+        self.use_mask_shader = bool(viewer_config.USE_MASK_SHADER and gsg and gsg.getSupportsBasicShaders())
+        self.mask_shader = make_mask_shader() if self.use_mask_shader else None
+        self._apply_scene_shader()
+        # "volume" draws the visible range as one instanced card over a texture array and
+        # "batched" merges every N layers into one Geom; both need the mask shader and
+        # texture arrays (volume also instancing), otherwise layers are drawn as cards
+        self.layer_renderer = None
+        mode = viewer_config.RENDER_MODE
+        if mode in ("volume", "batched"):
+            supported = self.use_mask_shader and gsg.getSupports2dTextureArray()
+            if mode == "volume" and supported and gsg.getSupportsGeometryInstancing():
+                self.layer_renderer = VolumeRenderer(self, EPSILON)
+            elif mode == "batched" and supported:
+                self.layer_renderer = LayerBatcher(self, EPSILON, viewer_config.BATCH_CHUNK_LAYERS)
+            else:
+                print(f"Render mode '{mode}' is not supported here; drawing layers as cards")
+        # Reduced-level card textures are packed into shared atlas pages (mask shader only)
+        self.use_texture_atlas = bool(viewer_config.ATLAS_FAST_TEXTURES and self.use_mask_shader)
+        self.atlases = {}        # pyramid level -> uploaded TextureAtlas
+        self.atlas_jobs = {}     # pyramid level -> (atlas, future) being packed in the background
+        # Per-layer texture levels for the card render mode, streamed from the camera
+        self.lod_manager = LODManager(self, int(viewer_config.LOD_UPLOAD_BUDGET_MB * 1024 * 1024))
+        budget_mb = viewer_config.RESIDENCY_VRAM_BUDGET_MB
+        self.residency = ResidencyManager(self, budget_mb * 1024 * 1024 if budget_mb is not None else None,
+                                          viewer_config.RESIDENCY_OCCLUSION_CUTOFF)
         # hook up controls
         self.setup_controls()
+        self.update_camera_position()
 
     def setup_controls(self):
         bw = self.base
@@ -111,24 +264,75 @@ class Viewer3D:
 
     # ── Public API ────────────────────────────────────────────────────────────
 
-    def load_print_directory(self, directory, on_status_update=None, on_progress_update=None):
-        if getattr(self, 'is_loading', False):
+    def load_print_directory(self, directory, on_status_update=None, on_progress_update=None, on_done=None):
+        return self._load_print(lambda processor: processor.load_print_directory(directory),
+                                on_status_update, on_progress_update, on_done)
+
+    def load_volume_file(self, volume_path, on_status_update=None, on_progress_update=None, on_done=None):
+        return self._load_print(lambda processor: processor.load_volume_file(volume_path),
+                                on_status_update, on_progress_update, on_done)
+
+    def export_volume(self, volume_path):
+        """Write the loaded print to a single memory-mappable volume file"""
+        if getattr(self, 'print_processor', None) is None:
+            return False
+        try:
+            self.print_processor.export_volume(volume_path)
+            return True
+        except Exception as e:
+            print(f"Error exporting volume: {e}")
+        return False
+
+    def _load_print(self, load, on_status_update=None, on_progress_update=None, on_done=None):
+        """Read a print and start loading its layers.
+
+        Without `on_done` the print is read right away and the result is returned.
+        With it, the print is read on a worker thread (the callbacks are then called
+        from that thread) and on_done(success) is called on the main thread once
+        its layers start loading; the return value only says whether it started.
+        """
+        if getattr(self, 'is_loading', False) or self._print_job is not None:
             return False
         try:
             # Pass the UI callbacks into PrintProcessor
-            processor = PrintProcessor(self.texture_cache,
-                                       on_status_update=on_status_update,
-                                       on_progress_update=on_progress_update)
-            if processor.load_print_directory(directory):
-                self.print_processor = processor
-                slice_data = processor.get_slice_data()
-                dimensions = processor.get_slice_dimensions()
-                self.load_slices(slice_data, dimensions, processor.layer_height)
+            processor = PrintProcessor(on_status_update=on_status_update,
+                                       on_progress_update=on_progress_update,
+                                       packed_masks=viewer_config.PACK_SLICE_MASKS,
+                                       slice_cache=self.slice_cache)
+            if on_done is not None:
+                self._print_job = (processor, self.thread_pool.submit(load, processor), on_done)
+                self.base.taskMgr.add(self._check_print_loading, "print-loader")
+                return True
+            if load(processor):
+                self._start_print(processor)
                 return True
         except Exception as e:
-            print(f"Error loading print directory: {e}")
+            print(f"Error loading print: {e}")
         return False
 
+    def _check_print_loading(self, task):
+        processor, future, on_done = self._print_job
+        if not future.done():
+            return task.cont
+        self._print_job = None
+        success = False
+        try:
+            if future.result():
+                self._start_print(processor)
+                success = True
+        except Exception as e:
+            print(f"Error loading print: {e}")
+        on_done(success)
+        return task.done
+
+    def _start_print(self, processor):
+        """Build the scene for a print the processor has read (main thread only)."""
+        self.print_processor = processor
+        self.image_store = processor.image_store
+        slice_data = processor.get_slice_data()
+        dimensions = processor.get_slice_dimensions()
+        self.load_slices(slice_data, dimensions, processor.layer_height)
+
 
     def load_slices(self, slice_data, dimensions, layer_height):
         """Initialize and kick off batch loading of all layers."""
@@ -136,6 +340,7 @@ class Viewer3D:
         if getattr(self, 'is_loading', False):
             return
         self.is_loading = True
+        self.mark_dirty()
 
         # store metadata
         self.slice_data = slice_data
@@ -148,109 +353,170 @@ class Viewer3D:
         self.available_types = sorted(all_types)
         self.enabled_types = set(self.available_types)
 
-        # dynamic exposure toggles
-        all_exposures = {
-            td.get('exposure_time')
-            for layer in slice_data
-            for td in layer.get('texture_data', [])
-            if td.get('exposure_time') is not None
-        }
+        # dynamic exposure toggles; images without an exposure time are listed as 0.0
+        all_exposures = {exp for layer in slice_data for exp in layer['exposure_times']}
         self.available_exposures = sorted(all_exposures)
         self.enabled_exposures = set(self.available_exposures)
 
+        # exposure colors are computed once per load and shared with the UI legend
+        self.exposure_colors = build_exposure_colors({
+            exp for layer in slice_data for exp in layer['exposure_times']
+            if exp is not None
+        })
+        self._exposure_color_opacity = None
+
         # reset scene
         self.root.removeNode()
         self.root = self.base.render.attachNewNode("root")
-        self.layer_nodes = {}
+        self._apply_scene_shader()
+        self._applied_range = None
+        self.layer_cards = {}
+        self.shown_layers = set()
+        self.card_groups = {}
         self.texture_cache.clear()
+        self.lod_manager.reset()
+        self.residency.reset()
+        self.atlases = {}
+        self.atlas_jobs = {}
+        if self.layer_renderer:
+            self.layer_renderer.clear()
+
+        # Center the stack up front, so the loader can rank layers by what the camera sees
+        height, width = self.image_store.shape(slice_data[0]['image_ids'][0])
+        spacing, _ = self._layer_geometry(height, width)
+        self.root.setPos(0, (1 + self.total_layers) / 2 * spacing, 0)
 
         # compute ranges
         self.update_layer_visibility()
         self.compute_exposure_range()
 
+        if self.layer_renderer:
+            # The visible range was built by update_layer_visibility
+            self.is_loading = False
+            return
+
+        # Cards start coarse and the LOD manager refines them once they are all shown
+        self.load_level = COARSEST_LEVEL if viewer_config.LOAD_COARSE_FIRST else self.texture_level
+        # pack the atlases in the background while the first batches are prepared
+        if self.use_texture_atlas:
+            for level in {FAST_LEVEL, max(self.load_level, FAST_LEVEL)}:
+                atlas = self._new_atlas()
+                future = self.thread_pool.submit(atlas.pack, self._all_image_ids(),
+                                                 lambda image_id, level=level: self._level_mask_image(image_id, level))
+                self.atlas_jobs[level] = (atlas, future)
+
         # start batch load
-        self.loading_batch = self.thread_pool.submit(self._prepare_next_batch, 0)
+        self.loading_batches = []
+        self._ready_layers = deque()
+        self._atlas_moves = deque()
+        self._pending_layers = set(range(1, self.total_layers + 1))
+        self._submit_load_batches()
         self.base.taskMgr.add(self._check_batch_loading, "batch-loader")
 
+    def mark_dirty(self):
+        """Request a redraw; the render loop skips frames while nothing changes."""
+        self._frame_dirty = True
+
+    def needs_frame(self):
+        """Return True if the next frame may differ from the last one (clears the dirty flag)."""
+        dirty, self._frame_dirty = self._frame_dirty, False
+        # Dragging, loading, a pending range and queued LOD work all change the picture every frame
+        return (dirty or self.mouse_down or self.right_mouse_down or self._range_dirty
+                or getattr(self, 'is_loading', False) or self.lod_manager.pending()
+                or bool(self.layer_renderer and self.layer_renderer.pending()))
+
     def toggle_image_type(self, img_type, enabled):
+        self.mark_dirty()
         if enabled:
             self.enabled_types.add(img_type)
         else:
             self.enabled_types.discard(img_type)
 
-        # Update the visibility of layers based on enabled image types.
-        for seq, node in self.layer_nodes.items():
-            layer_data = self.slice_data[seq - 1]  # layer data for this node
-
-            # Ensure 'texture_data' exists in the layer before accessing it
-            if 'texture_data' not in layer_data:
-                print(f"Warning: Missing 'texture_data' for layer {seq}. Skipping.")
-                continue
+        if self.layer_renderer:
+            self.layer_renderer.set_toggles(image_type=img_type)
+            return
 
-            # Show or hide texture cards for the specific image type
-            for idx, tex_data in enumerate(layer_data['texture_data']):
-                if tex_data['image_type'] == img_type:
-                    face = node.find(f"exposure_{idx}")
-                    if face.isEmpty():
-                        continue
-                    # Show only if both image type and exposure are enabled
-                    if img_type in self.enabled_types and tex_data.get('exposure_time') in self.enabled_exposures:
-                        face.show()
-                    else:
-                        face.hide()
+        self._update_group_visibility(image_type=img_type)
 
     def toggle_exposure(self, exposure, enabled):
+        self.mark_dirty()
         if enabled:
             self.enabled_exposures.add(exposure)
         else:
             self.enabled_exposures.discard(exposure)
 
-        # Update the visibility of layers based on enabled exposures.
-        for seq, node in self.layer_nodes.items():
-            layer_data = self.slice_data[seq - 1]
+        if self.layer_renderer:
+            self.layer_renderer.set_toggles(exposure=exposure)
+            return
 
-            # Ensure 'texture_data' exists in the layer before accessing it
-            if 'texture_data' not in layer_data:
-                continue
+        self._update_group_visibility(exposure=exposure)
 
-            # Show or hide texture cards for the specific exposure time
-            for idx, tex_data in enumerate(layer_data['texture_data']):
-                if tex_data.get('exposure_time') == exposure:
-                    face = node.find(f"exposure_{idx}")
-                    if face.isEmpty():
-                        continue
-                    # Show only if both exposure and image type are enabled
-                    if exposure in self.enabled_exposures and tex_data.get('image_type') in self.enabled_types:
-                        face.show()
-                    else:
-                        face.hide()
+    def _update_group_visibility(self, image_type=None, exposure=None):
+        """Show each matching card group only if both its image type and its exposure are enabled."""
+        for (exp, ttype), group in self.card_groups.items():
+            if image_type is not None and ttype != image_type:
+                continue
+            if exposure is not None and exp != exposure:
+                continue
+            if ttype in self.enabled_types and exp in self.enabled_exposures:
+                group.show()
+            else:
+                group.hide()
 
     def set_void_highlight(self, on: bool):
         self.void_highlight = on
         if on: self.void_only = False
-        self.reload_all_layers()
+        self._apply_mask_mode()
 
     def set_void_only(self, on: bool):
         self.void_only = on
         if on: self.void_highlight = False
-        self.reload_all_layers()
-
-    def set_quality_mode(self, high_quality: bool):
-        self.high_quality = high_quality
+        self._apply_mask_mode()
+
+    def set_layer_opacity(self, opacity: float):
+        self.layer_opacity = opacity
+        self.mark_dirty()
+        if self.use_mask_shader:
+            # Opacity is a shader uniform on the root: no texture or card changes
+            self.root.setShaderInput("layer_opacity", opacity)
+        else:
+            # Opacity is the alpha of each group's color scale
+            for (exp, _), group in self.card_groups.items():
+                self._apply_group_color(group, exp)
+
+    def set_quality_mode(self, mode: str):
+        """Set the quality mode: "auto", "fast" or "quality"."""
+        self.quality_mode = mode
+        self.texture_level = self._select_texture_level()
         self.update_layer_quality()
 
+    def _select_texture_level(self):
+        """Return the pyramid level to texture cards with in the current quality mode."""
+        if self.quality_mode == "quality":
+            return 0
+        if self.quality_mode == "fast" or not self.slice_data:
+            return FAST_LEVEL
+        # Screen pixels covered by one slice pixel at the orbit distance
+        height, width = self.image_store.shape(self.slice_data[0]['image_ids'][0])
+        _, scale = self._layer_geometry(height, width)
+        fov_v = np.deg2rad(self.base.camLens.getFov()[1])
+        view_height = 2 * max(self.camera_distance, 1e-6) * np.tan(fov_v / 2)
+        return int(level_for_ratio(scale / view_height * self.base.win.getYSize() / height))
+
     def set_layer_range(self, top=None, bottom=None):
         try:
             self.visible_range['top'] = int(top) if top is not None else None
             self.visible_range['bottom'] = int(bottom) if bottom is not None else None
-            self.update_layer_visibility()
         except:
             print("Invalid layer range")
+            return
+        # Slider drags fire on every mouse motion; the camera task applies the
+        # latest range at most once per rendered frame
+        self._range_dirty = True
 
     def toggle_pixel_mode(self):
         self.show_positive = not self.show_positive
-        self.texture_cache.clear()
-        self.update_layer_quality()
+        self._apply_mask_mode()
 
     def reload_all_layers(self):
         self.is_loading = False
@@ -258,30 +524,70 @@ class Viewer3D:
                          {'total_layers': self.total_layers, 'unique_layers': self.unique_layers},
                          self.layer_height)
 
-    def reload_layer_by_type(self, img_type):
-        """Reload only the layers related to the specified image type."""
-        for seq, node in self.layer_nodes.items():
-            layer_data = self.slice_data[seq - 1]
-            updated_texture_data = []
-            
-            # Check all textures for the current layer and adjust visibility
-            for tex_data in layer_data['texture_data']:
-                if tex_data['image_type'] == img_type:
-                    tex = self.texture_cache.get(tex_data['texture_key'])
-                    if tex is None:
-                        tex = self.create_texture_from_image(tex_data['img'])  # Assuming this method exists
-                    face = node.find(f"exposure_{seq}")
-                    face.setTexture(tex)
-                    face.setColorScale(self.get_exposure_color(tex_data['exposure_time'], layer_data['layer_number']))
-                    # Apply visibility toggle
-                    if img_type in self.enabled_types:
-                        face.show()
-                    else:
-                        face.hide()
-
 
     # ── Internal helpers ──────────────────────────────────────────────────────
 
+    def _apply_scene_shader(self):
+        """Attach the mask shader and its global uniforms to the scene root."""
+        if not self.use_mask_shader:
+            return
+        self.root.setShader(self.mask_shader)
+        self.root.setShaderInput("exposure_color", Vec4(1.0, 1.0, 1.0, 1.0))
+        self.root.setShaderInput("layer_opacity", self.layer_opacity)
+        self.root.setShaderInput("mask_mode", float(self._texture_mode()))
+        self.root.setShaderInput("light_scale", self._scene_light_scale())
+
+    def _scene_light_scale(self):
+        """Return the lighting setShaderAuto gives the cards: ambient plus the key light's diffuse term.
+
+        Every card faces -Y in the root's space and the lights are parented to the
+        root, so the term is the same for all cards and does not change with the view.
+        """
+        to_light = -self.root.getRelativeVector(self.directional_np, Vec3(0, 1, 0))
+        to_light.normalize()
+        diffuse = max(0.0, Vec3(0, -1, 0).dot(to_light))
+        ambient = self.ambient_np.node().getColor().getXyz()
+        key = self.directional_np.node().getColor().getXyz()
+        return ambient + key * diffuse
+
+    def _apply_mask_mode(self):
+        """Apply the current positive/negative/void mode to the scene."""
+        self.mark_dirty()
+        if self.use_mask_shader:
+            # The mode is a shader uniform, so nothing is rebuilt
+            self.root.setShaderInput("mask_mode", float(self._texture_mode()))
+        elif self.layer_cards:
+            # The mode is part of the texture key, so every mode's textures stay cached;
+            # the existing cards are re-textured in place a few layers per frame
+            self.lod_manager.invalidate(retexture=True)
+
+    def _texture_mode(self):
+        return texture_mode(self.show_positive, self.void_highlight, self.void_only)
+
+    def _apply_group_color(self, group, exposure_time):
+        color = self.get_exposure_color(exposure_time, None)
+        if self.use_mask_shader:
+            # Opacity comes from the root's layer_opacity uniform
+            group.setShaderInput("exposure_color", color)
+        else:
+            group.setColorScale(color)
+
+    def _card_group(self, exposure_time, image_type):
+        """Return the parent node holding the render state shared by cards of one exposure and type."""
+        key = (exposure_time, image_type)
+        group = self.card_groups.get(key)
+        if group is None:
+            group = self.root.attachNewNode(f"cards_{image_type}_{exposure_time}")
+            group.setTwoSided(True)
+            group.setTransparency(TransparencyAttrib.MAlpha)
+            group.setDepthWrite(False)
+            group.setBin("transparent", 0)
+            self._apply_group_color(group, exposure_time)
+            if image_type not in self.enabled_types or exposure_time not in self.enabled_exposures:
+                group.hide()
+            self.card_groups[key] = group
+        return group
+
     def compute_exposure_range(self):
         min_e = None; max_e = None
         for layer in self.slice_data:
@@ -294,24 +600,62 @@ class Viewer3D:
         self.min_exposure, self.max_exposure = min_e, max_e
         print(f"Computed exposure range: {min_e}–{max_e} ms")
 
-    def _prepare_next_batch(self, start_index):
-        end = min(start_index + self.BATCH_SIZE, self.total_layers)
-        batch = [self._prepare_layer_data(self.slice_data[i], i) for i in range(start_index, end)]
-        return batch, start_index, end
+    def _load_order(self, seqs):
+        """Sort layers for loading: visible range first, then in view, then nearest to the camera."""
+        seqs = np.asarray(seqs)
+        bottom, top = self._range_bounds()
+        in_range = (seqs >= bottom) & (seqs <= top)
+        height, width = self.image_store.shape(self.slice_data[0]['image_ids'][0])
+        spacing, scale = self._layer_geometry(height, width)
+        in_view = self.residency.in_frustum(seqs, spacing, scale, width / height)
+        _, _, dist = self.lod_manager.desired_levels(seqs)
+        return seqs[np.lexsort((dist, ~in_view, ~in_range))].tolist()
+
+    def _submit_load_batches(self):
+        """Keep LOAD_BATCHES_IN_FLIGHT batches of the highest priority pending layers preparing."""
+        # Layers waiting for the main thread count against the limit, so workers never run far ahead
+        free = (viewer_config.LOAD_BATCHES_IN_FLIGHT - len(self.loading_batches)
+                - len(self._ready_layers) // self.BATCH_SIZE)
+        if free <= 0 or not self._pending_layers:
+            return
+        # Re-ranked on every submit, so camera and range changes during loading are followed
+        order = self._load_order(sorted(self._pending_layers))[:free * self.BATCH_SIZE]
+        self._pending_layers.difference_update(order)
+        for start in range(0, len(order), self.BATCH_SIZE):
+            self.loading_batches.append(
+                self.thread_pool.submit(self._prepare_layers, order[start:start + self.BATCH_SIZE]))
+
+    def _prepare_layers(self, seqs):
+        """Worker side of a batch: layer data plus the textures its cards start with.
+
+        Textures are built into the texture cache with their RAM images set, so the
+        main thread only attaches cards and the GPU upload happens at render time.
+        """
+        level = self.load_level
+        # Atlas levels need no per-card textures, unless the atlas is still being packed:
+        # those cards start on standalone textures and move onto the atlas once it is uploaded
+        atlas_level = self.use_texture_atlas and level >= FAST_LEVEL and level not in self.atlas_jobs
+        batch = [self._prepare_layer_data(self.slice_data[seq - 1], seq - 1) for seq in seqs]
+        for data in batch:
+            for td in data['texture_data']:
+                if atlas_level:
+                    self.image_store.levels(td['image_id'])
+                else:
+                    self.create_texture_from_image(td['image_id'], level)
+        return batch
 
     def _prepare_layer_data(self, layer, index):
         seq = index + 1
         ln  = layer.get('layer_number', seq)
         tex_list = []
-        for img, exp, ttype in zip(layer['images'], layer['exposure_times'], layer['image_types']):
-            if ttype not in self.enabled_types:
-                continue
+        # Cards of disabled types are still created; their group is hidden
+        for image_id, exp, ttype in zip(layer['image_ids'], layer['exposure_times'], layer['image_types']):
+            height, width = self.image_store.shape(image_id)
             tex_list.append({
-                'img': img,
-                'aspect_ratio': img.shape[1]/img.shape[0],
+                'image_id': image_id,
+                'aspect_ratio': width/height,
                 'exposure_time': exp,
-                'image_type': ttype,
-                'texture_key': self.texture_cache.get_texture_key(img, self.show_positive)
+                'image_type': ttype
             })
         return {'sequence_number': seq,
                 'layer_number': ln,
@@ -319,116 +663,93 @@ class Viewer3D:
                 'duplicate_index': layer.get('duplicate_index')}
 
     def _check_batch_loading(self, task):
-        if not self.loading_batch.done():
-            return task.cont
-        batch, start, end = self.loading_batch.result()
-        for layer_data in batch:
-            self._create_layer_node(layer_data)
-        if end < self.total_layers:
-            self.loading_batch = self.thread_pool.submit(self._prepare_next_batch, end)
+        for level, (_, future) in list(self.atlas_jobs.items()):
+            if future.done():
+                self._upload_atlas(level)
+                # Layers created while the atlas was packed move onto it
+                self._atlas_moves.extend(seq for seq, applied in self.lod_manager.levels.items()
+                                         if applied == level)
+        for future in [f for f in self.loading_batches if f.done()]:
+            self.loading_batches.remove(future)
+            self._ready_layers.extend(future.result())
+        # Attach layers until this frame's budget is spent (at least one per frame)
+        deadline = self._frame_deadline()
+        while self._ready_layers:
+            self._create_layer_node(self._ready_layers.popleft(), self.load_level)
+            if time.perf_counter() >= deadline:
+                break
+        # Then re-texture moved layers with what is left of it
+        while self._atlas_moves and time.perf_counter() < deadline:
+            seq = self._atlas_moves.popleft()
+            self._apply_layer_level(seq, self.lod_manager.levels[seq])
+        self._submit_load_batches()
+        if self.loading_batches or self._ready_layers or self.atlas_jobs or self._atlas_moves:
             return task.cont
-        else:
-            self.is_loading = False
-            # center pivot
-            b = self.root.getBounds().getCenter()
-            self.root.setPos(-b.getX(), -b.getY(), -b.getZ())
-            return task.done
+        self.is_loading = False
+        return task.done
+
+    def _frame_deadline(self):
+        """Return the time by which this frame's scene building should stop."""
+        return time.perf_counter() + viewer_config.FRAME_BUILD_BUDGET_MS / 1000
 
-    def _create_layer_node(self, data):
+    def _create_layer_node(self, data, level):
         seq = data['sequence_number']
-        ln  = data['layer_number']
-        node = self.root.attachNewNode(f"layer_{ln}")
-        self.layer_nodes[seq] = node
-        first = None
-        y_offset = 0  # Start stacking from y_offset = 0
+        cards = []
+        self.layer_cards[seq] = cards
+        if not data['texture_data']:
+            return
+        height, width = self.image_store.shape(data['texture_data'][0]['image_id'])
+        spacing, scale = self._layer_geometry(height, width)
+        bottom, top = self._range_bounds()
+        shown = bottom <= seq <= top
+        if shown:
+            self.shown_layers.add(seq)
 
         for idx, td in enumerate(data['texture_data']):
-            if first is None: first = td
-            tex = self.texture_cache.get(td['texture_key'])
-            if tex is None:
-                tex = self.create_texture_from_image(td['img'])
-            
             cm = CardMaker(f"exposure_{idx}")
             cm.setFrame(-td['aspect_ratio']/2, td['aspect_ratio']/2, -0.5, 0.5)
-            face = node.attachNewNode(cm.generate())
+            # Cards carry the layer transform themselves; transparency, two-sidedness,
+            # depth write, bin and color live on the shared group node
+            face = self._card_group(td['exposure_time'], td['image_type']).attachNewNode(cm.generate())
             face.setR(90)  # Rotate the card to align properly
-            face.setTwoSided(True)
-            face.setTexture(tex)
-            ### face.setColorScale(self.get_exposure_color(td['exposure_time'], data['layer_number'])) ### for gradient style exposure colors
-            face.setColorScale(self.get_exposure_color(td['exposure_time'], data['layer_number']))
-            face.setTransparency(TransparencyAttrib.MAlpha)
-            face.setAlphaScale(self.layer_opacity)
-            face.setDepthWrite(False)
-            face.setBin("transparent", 0)
-            
-            # Stack cards with the epsilon value in the y_offset direction
-            face.setPos(0, y_offset, 0)
-            y_offset += EPSILON  # Increase the offset slightly to avoid clipping
-        
-        # Update layer position based on texture size
-        if first:
-            img = first['img']
-            spacing = viewer_config.REAL_PROPORTION * min(img.shape[1], img.shape[0]) * viewer_config.IMAGE_SCALE_FACTOR
-            node.setPos(0, -seq * spacing, 0)
-            node.setScale(img.shape[1]/first['aspect_ratio'])
+            face.setScale(scale)
+            # Stack cards with the epsilon value in the y_offset direction to avoid clipping
+            face.setPos(0, -seq * spacing + idx * EPSILON * scale, 0)
+            self._apply_card_texture(face, td['image_id'], level)
+            if not shown:
+                face.hide()
+
+            cards.append((face, td))
+        self.lod_manager.set_level(seq, level)
+
+    def _layer_geometry(self, height, width):
+        """Return (layer spacing, card scale) for slices of the given size."""
+        spacing = viewer_config.REAL_PROPORTION * min(width, height) * viewer_config.IMAGE_SCALE_FACTOR
+        return spacing, height
 
     def get_exposure_color(self, exposure_time, layer_number):
         """
-        Assign a color to the given exposure time, grouping exposure times within ±50ms.
-        Exposure times in the same group share a base color with light/dark variants.
+        Return the Vec4 color for an exposure time at the current layer opacity.
+        Colors come from the table built once per load by build_exposure_colors.
         """
-        # Gather all distinct exposure times from the slice data
-        exposure_times = sorted({
-            exp for layer in self.slice_data for exp in layer['exposure_times']
-            if exp is not None
-        })
-        # Group exposure times within ±50 ms (max 3 per group)
-        groups = []
-        current_group = []
-        for exp in exposure_times:
-            if not current_group:
-                current_group = [exp]
-            elif exp - current_group[0] <= 50 and len(current_group) < 3:
-                current_group.append(exp)
-            else:
-                groups.append(current_group)
-                current_group = [exp]
-        if current_group:
-            groups.append(current_group)
-        # Assign colors to each exposure time based on its group
-        exposure_time_to_color = {}
-        color_list = viewer_config.EXPOSURE_COLORS
-        color_count = len(color_list)
-        for idx, group in enumerate(groups):
-            base_hex = color_list[idx % color_count]
-            # Convert base color from hex to Vec4 (RGBA) for calculations
-            r = int(base_hex[1:3], 16) / 255.0
-            g = int(base_hex[3:5], 16) / 255.0
-            b = int(base_hex[5:7], 16) / 255.0
-            base_color = Vec4(r, g, b, self.layer_opacity)
-            # Prepare white and black (with same opacity) for shading
-            white = Vec4(1.0, 1.0, 1.0, self.layer_opacity)
-            black = Vec4(0.0, 0.0, 0.0, self.layer_opacity)
-            if len(group) == 1:
-                # Single exposure uses the base color
-                exposure_time_to_color[group[0]] = base_color
-            elif len(group) == 2:
-                # Two exposures: lighter shade for lower value, darker for higher value
-                light_color = lerp_color(base_color, white, 0.5)
-                dark_color = lerp_color(base_color, black, 0.5)
-                exposure_time_to_color[group[0]] = light_color
-                exposure_time_to_color[group[1]] = dark_color
-            elif len(group) == 3:
-                # Three exposures: low→light, mid→base, high→dark
-                light_color = lerp_color(base_color, white, 0.5)
-                dark_color = lerp_color(base_color, black, 0.5)
-                exposure_time_to_color[group[0]] = light_color
-                exposure_time_to_color[group[1]] = base_color
-                exposure_time_to_color[group[2]] = dark_color
-        # Return the Vec4 color (default to white if exposure_time not found)
-        color = exposure_time_to_color.get(exposure_time, Vec4(1.0, 1.0, 1.0, self.layer_opacity))
+        if self._exposure_color_opacity != self.layer_opacity:
+            # Only rebuilt when the opacity changes, not once per card
+            self._exposure_color_vecs = {
+                exp: Vec4(r, g, b, self.layer_opacity)
+                for exp, (r, g, b) in self.exposure_colors.items()
+            }
+            self._exposure_color_opacity = self.layer_opacity
+        # Default to white if exposure_time not found
+        color = self._exposure_color_vecs.get(exposure_time)
+        if color is None:
+            color = Vec4(1.0, 1.0, 1.0, self.layer_opacity)
         return color
 
+    def get_exposure_hex(self, exposure_time):
+        """Return the '#rrggbb' color for an exposure time (used by the UI legend)."""
+        r, g, b = self.exposure_colors.get(exposure_time, (1.0, 1.0, 1.0))
+        return f"#{round(r * 255):02x}{round(g * 255):02x}{round(b * 255):02x}"
+
 
 ### for gradient style exposure colors ###
     # def get_exposure_color(self, exposure_time, layer_number):
@@ -471,120 +792,151 @@ class Viewer3D:
     #     # Apply your UI opacity
     #     return Vec4(base[0], base[1], base[2], self.layer_opacity)
 
-    def create_texture_from_image(self, img):
-        base_key = self.texture_cache.get_texture_key(img, self.show_positive)
-        q_key = f"{base_key}_{self.high_quality}_{self.layer_opacity:.2f}"
+    def _texture_key(self, image_id, level):
+        mode = None if self.use_mask_shader else self._texture_mode()
+        return f"{self.image_store.digest(image_id)}_{'mask' if mode is None else mode}_{level}"
+
+    def create_texture_from_image(self, image_id, level=None):
+        """Return the cached texture for an image in the current mode, building it if needed."""
+        # Mask textures are mode independent; the shader applies the mode
+        mode = None if self.use_mask_shader else self._texture_mode()
+        if level is None:
+            level = self.texture_level
+        q_key = self._texture_key(image_id, level)
         tex = self.texture_cache.get(q_key)
         if tex: return tex
-        if not self.high_quality:
-            sf = 0.25
-            img = cv2.resize(img, (int(img.shape[1]*sf), int(img.shape[0]*sf)), interpolation=cv2.INTER_AREA)
-        img_rgba = np.zeros((*img.shape,4),dtype=np.uint8)
-        a = int(255*self.layer_opacity)
-        if self.show_positive:
-            img_rgba[img>0] = [255,255,255,a]
+        # Pyramid levels are precomputed; GPU mipmaps handle minification within a level
+        mask = self.image_store.get_mask(image_id, level)
+        if mode is None:
+            tex = make_texture(build_mask_image(mask), Texture.F_red, compress=level > 0, mipmap=True)
         else:
-            img_rgba[img==0] = [255,255,255,a]
-        # void‐mode
-        if self.void_only or self.void_highlight:
-            img_rgba[img>0] = [0,0,0,0]
-            if self.void_only:
-                img_rgba[img==0] = [255,255,255,a]
-            else:
-                img_rgba[img==0] = [0,0,255,a]
-        tex = Texture("layer_tex")
-        tex.setup2dTexture(img_rgba.shape[1], img_rgba.shape[0],
-                           Texture.T_unsigned_byte, Texture.F_rgba)
-        
-        tex.setWrapU(SamplerState.WM_clamp)
-        tex.setWrapV(SamplerState.WM_clamp)
-        tex.setMinfilter(SamplerState.FT_linear)
-        tex.setMagfilter(SamplerState.FT_linear)
-
-        tex.setRamImage(img_rgba.tobytes())
-        if not self.high_quality:
-            tex.setCompression(Texture.CMDefault)
+            tex = make_texture(build_rgba(mask, mode), compress=level > 0, mipmap=True)
         self.texture_cache.put(q_key, tex)
         return tex
 
+    def _all_image_ids(self):
+        return sorted({image_id for layer in self.slice_data for image_id in layer['image_ids']})
+
+    def _level_mask_image(self, image_id, level):
+        return build_mask_image(self.image_store.get_mask(image_id, level))
+
+    def _new_atlas(self):
+        return TextureAtlas(min(viewer_config.ATLAS_PAGE_SIZE, self.base.win.getGsg().getMaxTextureDimension()))
+
+    def _upload_atlas(self, level):
+        """Create a packed atlas' pages and queue them for upload in one go."""
+        atlas, future = self.atlas_jobs.pop(level)
+        future.result()
+        atlas.upload(self.base.win.getGsg().getPreparedObjects(), compress=True)
+        self.atlases[level] = atlas
+
+    def _atlas_for_level(self, level):
+        """Return the uploaded atlas for a reduced pyramid level, if atlases are in use."""
+        if not self.use_texture_atlas or level < FAST_LEVEL:
+            return None
+        atlas = self.atlases.get(level)
+        if atlas is None and level > FAST_LEVEL and self.slice_data and level not in self.atlas_jobs:
+            # Coarser levels are tiny and already decoded, so they are packed on first use
+            atlas = self._new_atlas()
+            atlas.pack(self._all_image_ids(), lambda image_id: self._level_mask_image(image_id, level))
+            atlas.upload(self.base.win.getGsg().getPreparedObjects(), compress=True)
+            self.atlases[level] = atlas
+        return atlas
+
+    def _apply_card_texture(self, face, image_id, level=None):
+        """Texture a card: an atlas tile for reduced levels when available, else its own texture."""
+        if level is None:
+            level = self.texture_level
+        tile = None
+        atlas = self._atlas_for_level(level)
+        if atlas is not None and image_id in atlas:
+            tile = atlas.lookup(image_id)
+        if tile is not None:
+            tex, transform = tile
+            face.setTexture(tex)
+            face.setTexTransform(TextureStage.getDefault(), transform)
+        else:
+            face.setTexture(self.create_texture_from_image(image_id, level))
+            face.clearTexTransform()
+
     def update_layer_visibility(self):
-        """Show/hide nodes by visible_range."""
-        for seq, node in self.layer_nodes.items():
-            vis = True
-            top = self.visible_range['top']
-            bot = self.visible_range['bottom']
-            if top is not None and seq > top: vis = False
-            if bot is not None and seq < bot: vis = False
-            node.show() if vis else node.hide()
-
-    def update_layer_quality(self):
-        if not self.layer_nodes: return
+        """Show/hide layer cards by visible_range."""
+        if self.layer_renderer:
+            if self.slice_data:
+                self.layer_renderer.set_range()
+            return
+        bottom, top = self._range_bounds()
+        if self._applied_range is None:
+            changed = self.layer_cards.keys()
+        else:
+            # Only layers entering or leaving the range change state
+            old_bottom, old_top = self._applied_range
+            changed = set(range(min(bottom, old_bottom), max(bottom, old_bottom)))
+            changed.update(range(min(top, old_top) + 1, max(top, old_top) + 1))
+        for seq in changed:
+            shown = bottom <= seq <= top
+            if shown:
+                self.shown_layers.add(seq)
+            else:
+                self.shown_layers.discard(seq)
+            for face, _ in self.layer_cards.get(seq, ()):
+                face.show() if shown else face.hide()
+        self._applied_range = (bottom, top)
+
+    def _range_bounds(self):
+        """Return the visible (bottom, top) sequence numbers, inclusive."""
+        bottom = self.visible_range['bottom']
+        top = self.visible_range['top']
+        return (1 if bottom is None else bottom,
+                self.total_layers if top is None else top)
+
+    def update_layer_quality(self, retexture=False):
+        """Re-texture for a new quality mode; `retexture` also refreshes layers already at their level."""
+        if not self.layer_cards and not (self.layer_renderer and self.slice_data): return
         if not hasattr(self, 'status_text'):
             self.status_text = OnscreenText("", pos=viewer_config.STATUS_TEXT_POS,
                                            scale=viewer_config.STATUS_TEXT_SCALE,
                                            mayChange=True)
-        self.status_text.setText("High Quality" if self.high_quality else "Fast Render")
-        self.thread_pool.submit(self._update_layer_quality_async)
-
-    def _update_layer_quality_async(self):
-        for seq, node in self.layer_nodes.items():
-            if node.isHidden(): continue
-            layer = self.slice_data[seq-1]
-            data  = self._prepare_layer_data(layer, seq-1)
-            self.base.taskMgr.add(self._update_node_quality,
-                                  f"uq_{seq}", extraArgs=[data], appendTask=True)
-        def done(task):
-            self.status_text.setText("Done Quality Update")
-            return task.done
-        self.base.taskMgr.add(done, "uq_done")
-
-    def _update_node_quality(self, layer_data, task):
-        seq = layer_data['sequence_number']
-        node = self.layer_nodes.get(seq)
-        if node:
-            for idx, td in enumerate(layer_data['texture_data']):
-                tex = self._get_quality_texture(td)
-                face = node.find(f"exposure_{idx}")
-                if not face.isEmpty():
-                    face.setTexture(tex)
-                    face.setColorScale(self.get_exposure_color(td['exposure_time'], layer_data['layer_number']))
-        return task.done
+        self.mark_dirty()
+        self.status_text.setText(f"{viewer_config.QUALITY_MODE_LABELS[self.quality_mode]} "
+                                 f"(1/{round(1 / PYRAMID_SCALES[self.texture_level])} resolution)")
+        if self.layer_renderer:
+            # Repack the visible range at the new resolution
+            self.layer_renderer.rebuild_textures()
+            return
+        # The LOD manager re-textures visible layers, largest on screen first, a few per frame
+        self.lod_manager.invalidate(retexture)
 
-    def _get_quality_texture(self, td):
-        base_key = td['texture_key']
-        q_key = f"{base_key}_{self.high_quality}_{self.layer_opacity:.2f}"
-        tex = self.texture_cache.get(q_key)
-        if tex: return tex
-        img = td['img']
-        if not self.high_quality:
-            sf = 0.25
-            img = cv2.resize(img, (int(img.shape[1]*sf), int(img.shape[0]*sf)), interpolation=cv2.INTER_AREA)
-        img_rgba = np.zeros((*img.shape,4),dtype=np.uint8)
-        if self.show_positive:
-            img_rgba[img>0] = [255,255,255,255]
-        else:
-            img_rgba[img==0] = [255,255,255,255]
-        if self.void_only or self.void_highlight:
-            img_rgba[img>0] = [0,0,0,0]
-            if self.void_only:
-                img_rgba[img==0] = [255,255,255,255]
-            else:
-                a = int(255*self.layer_opacity)
-                img_rgba[img==0] = [0,0,255,a]
-        tex = Texture("layer_tex")
-        tex.setup2dTexture(img_rgba.shape[1], img_rgba.shape[0],
-                           Texture.T_unsigned_byte, Texture.F_rgba)
-        
-        tex.setWrapU(SamplerState.WM_clamp)
-        tex.setWrapV(SamplerState.WM_clamp)
-        tex.setMinfilter(SamplerState.FT_linear)
-        tex.setMagfilter(SamplerState.FT_linear)
-
-        tex.setRamImage(img_rgba.tobytes())
-        if not self.high_quality:
-            tex.setCompression(Texture.CMDefault)
-        self.texture_cache.put(q_key, tex)
-        return tex
+    def _on_quality_update_done(self):
+        if hasattr(self, 'status_text'):
+            self.status_text.setText("Done Quality Update")
+            self.mark_dirty()
+
+    def _apply_layer_level(self, seq, level):
+        """Texture a layer's cards at a pyramid level."""
+        for face, td in self.layer_cards.get(seq, ()):
+            self._apply_card_texture(face, td['image_id'], level)
+
+    def _layer_level_bytes(self, seq, level):
+        """Return the texel bytes a layer's cards may upload at a pyramid level."""
+        bytes_per_texel = 1 if self.use_mask_shader else 4
+        cost = 0
+        for _, td in self.layer_cards.get(seq, ()):
+            height, width = self.image_store.shape(td['image_id'], level)
+            cost += height * width * bytes_per_texel
+        return cost
+
+    def _layer_level_ready(self, seq, level):
+        """Return True if a layer's cards can be textured at a level without building textures."""
+        atlas = self._atlas_for_level(level)
+        return all((atlas is not None and td['image_id'] in atlas)
+                   or self._texture_key(td['image_id'], level) in self.texture_cache
+                   for _, td in self.layer_cards.get(seq, ()))
+
+    def _build_layer_level(self, seq, level):
+        """Worker side of a level change: build a layer's textures at the level into the cache."""
+        for _, td in self.layer_cards.get(seq, ()):
+            self.create_texture_from_image(td['image_id'], level)
 
     # --- Navigation Event Handlers and Camera Controls ---
 
@@ -686,9 +1038,31 @@ class Viewer3D:
                 pan_offset = (right_vec * dx + up_vec * dy) * pan_factor
                 # Move the entire scene (root node) by this offset
                 self.root.setPos(self.root.getPos() + pan_offset)
+                self._view_changed = True
+                self.mark_dirty()
 
             self.last_x, self.last_y = x, y
-        self.update_camera_position()
+        # The camera is only repositioned by the handlers that move it, so an idle frame does no camera work
+        view_changed, self._view_changed = self._view_changed, False
+        if self._range_dirty:
+            self._range_dirty = False
+            self.update_layer_visibility()
+        if self.layer_renderer:
+            # Texture arrays are built on the pool and attached within the frame build budget
+            if self.layer_renderer.attach_ready(self._frame_deadline()):
+                self.mark_dirty()
+            # Texture-array renderers use one level for the whole range
+            if (view_changed and self.quality_mode == "auto" and self.slice_data
+                    and not getattr(self, 'is_loading', False)):
+                level = self._select_texture_level()
+                if level != self.texture_level:
+                    self.texture_level = level
+                    self.update_layer_quality()
+            self.layer_renderer.update_draw_order(self.base.camera)
+        elif not getattr(self, 'is_loading', False):
+            # Refinement waits for loading (and the atlases being packed), so it neither competes
+            # with the frame build budget nor builds textures the atlases replace
+            self.lod_manager.update()
         return task.cont
 
     def update_camera_position(self):
@@ -701,6 +1075,8 @@ class Viewer3D:
         z = self.camera_distance * np.sin(pp)
         self.base.camera.setPos(self.camera_target + Vec3(x, y, z))
         self.base.camera.lookAt(self.camera_target)
+        self._view_changed = True
+        self.mark_dirty()
 
     def reset_view(self):
         """Reset camera to the initial home position and orientation."""
@@ -710,6 +1086,8 @@ class Viewer3D:
         self.camera_p = viewer_config.INITIAL_CAMERA_P
         self.base.camera.setPos(viewer_config.INITIAL_CAMERA_POS)
         self.base.camera.lookAt(self.camera_target)
+        self._view_changed = True
+        self.mark_dirty()
 
 if __name__ == "__main__":
     base = ShowBase()
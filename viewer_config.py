@@ -283,6 +283,48 @@ REAL_PROPORTION = 10.0 / 7.6  # Layer thickness divided by pixel size
 IMAGE_SCALE_FACTOR = 0.00075  # Percentage of image width for spacing
 EXPOSURE_SPACING_FACTOR = 0.1  # Relative spacing between exposures
 
+# Slice storage
+PACK_SLICE_MASKS = True  # Keep slices as bit-packed masks (~8x less RAM); unpacked only when a texture is built
+SLICE_CACHE_ENABLED = True  # Keep decoded slices on disk so reopening an unchanged print skips PNG decoding
+SLICE_CACHE_DIR = None      # None = per-user cache directory (e.g. ~/.cache/3d_slice_viewer)
+
+# Texture cache
+TEXTURE_CACHE_BUDGET_MB = 1024  # Least recently used textures are evicted above this size
+USE_MASK_SHADER = True          # 1-byte mask textures colored by a GLSL shader (falls back to RGBA if unsupported)
+ATLAS_FAST_TEXTURES = True      # Pack fast-mode slices into shared atlas pages instead of one texture each
+ATLAS_PAGE_SIZE = 4096          # Atlas page width/height in pixels (capped by the GPU maximum)
+
+# Render quality
+DEFAULT_QUALITY_MODE = "auto"   # "auto": pyramid level from on-screen size; "fast": 1/4 size; "quality": full size
+QUALITY_MODE_LABELS = {"auto": "Auto Quality", "fast": "Fast Render", "quality": "Quality Render"}
+LOD_UPLOAD_BUDGET_MB = 16       # Texel data re-textured per frame when layers change level
+RESIDENCY_VRAM_BUDGET_MB = 512  # Layer textures above this are coarsened, farthest layers first (None = no limit)
+RESIDENCY_OCCLUSION_CUTOFF = 0.01  # Layers receiving less light than this through nearer layers count as hidden
+
+# Rendering
+RENDER_MODE = "cards"  # "cards": one card per slice image; "volume": visible range in texture arrays, one instanced draw each;
+                       # "batched": every BATCH_CHUNK_LAYERS layers merged into one Geom
+BATCH_CHUNK_LAYERS = 32  # Layers per chunk in the batched render mode
+VOLUME_VRAM_BUDGET_MB = 512  # Volume texture arrays above this use a coarser pyramid level (None = no limit)
+
+# Loading
+LOAD_BATCHES_IN_FLIGHT = 4  # Layer batches prepared in parallel; layers in the visible range and view go first
+LOAD_COARSE_FIRST = True    # Create cards at the coarsest pyramid level; the LOD manager refines them afterwards
+FRAME_BUILD_BUDGET_MS = 4.0 # Main-thread time per frame spent attaching loaded layers to the scene
+
+# Render loop
+RENDER_LOOP = "paced"       # "paced": frames at RENDER_TARGET_FPS, RENDER_IDLE_FPS while nothing changes; "fixed": every 33 ms
+RENDER_TARGET_FPS = None    # Frame rate while the view changes; None: the display refresh rate (60 if unknown)
+RENDER_IDLE_FPS = 20        # Frame rate while nothing changes (input is still polled)
+RENDER_ON_DEMAND = True     # Stop drawing while nothing changes; input and loading are polled at RENDER_IDLE_FPS
+SHOW_FPS_OVERLAY = False    # Frame rate meter and frame time overlay (toggle with F)
+FPS_OVERLAY_INTERVAL_MS = 500  # Refresh interval of the frame time overlay text
+FPS_OVERLAY_POS = (0.05, 0.15)  # Relative to the bottom-left window corner
+FPS_OVERLAY_SCALE = 0.045
+
+# Progress reporting
+PROGRESS_REFRESH_MS = 100   # Loading progress posted by workers is shown at most this often
+
 
 def get_window_properties():
     """Get the window properties for Panda3D."""
@@ -3,11 +3,13 @@ from tkinter import Tk
 from tkinter import ttk, filedialog
 import ttkbootstrap as ttkb
 from direct.showbase.ShowBase import ShowBase
-import time
 import sys
 from panda3d.core import WindowProperties
 
 import viewer_config  # Import configuration settings
+from volume_file import VOLUME_EXTENSION
+from render_loop import RenderLoop
+from progress_channel import ProgressChannel
 
 class VerticalRangeSlider(tk.Canvas):
     def __init__(self, parent, min_val, max_val, initial_bottom, initial_top,
@@ -92,6 +94,7 @@ class VerticalRangeSlider(tk.Canvas):
         # Convert y into a value
         value = self.max_val - ((y - self.line_y0) / line_length) * (self.max_val - self.min_val)
         value = round(value)
+        previous = (self.bottom_val, self.top_val)
         if handle == "bottom":
             # Ensure the bottom handle cannot go above the top handle.
             if value >= self.top_val:
@@ -101,6 +104,8 @@ class VerticalRangeSlider(tk.Canvas):
             if value <= self.bottom_val:
                 value = self.bottom_val + 1
             self.top_val = min(self.max_val, value)
+        if (self.bottom_val, self.top_val) == previous:
+            return  # sub-layer mouse motion: nothing to redraw or report
         self.update_handle_positions()
         if self.callback:
             self.callback(self.bottom_val, self.top_val)
@@ -280,52 +285,12 @@ class ViewerApp:
         legend_frame.pack(fill=tk.X, padx=viewer_config.PADDING, pady=viewer_config.PADDING)
         
         # Collect and sort unique exposure times
-        exposure_times = sorted({
-            td.get('exposure_time') 
-            for layer in self.viewer.slice_data 
-            for td in layer.get('texture_data', [])
-            if td.get('exposure_time') is not None
-        })
-
-        # Group exposure times within ±50 ms (max 3 per group)
-        groups = []
-        current_group = []
-        for exp in exposure_times:
-            if not current_group:
-                current_group = [exp]
-            elif exp - current_group[0] <= 50 and len(current_group) < 3:
-                current_group.append(exp)
-            else:
-                groups.append(current_group)
-                current_group = [exp]
-        if current_group:
-            groups.append(current_group)
-        
-        # Determine color for each exposure time (light/base/dark per group)
-        exposure_color_map = {}
-        colors = viewer_config.EXPOSURE_COLORS
-        for idx, group in enumerate(groups):
-            base_hex = colors[idx % len(colors)]
-            r = int(base_hex[1:3], 16); g = int(base_hex[3:5], 16); b = int(base_hex[5:7], 16)
-            if len(group) == 1:
-                exposure_color_map[group[0]] = base_hex
-            elif len(group) == 2:
-                # Two exposures: compute lighter and darker shades of the base color
-                light_r = round(r + (255 - r) * 0.5); light_g = round(g + (255 - g) * 0.5); light_b = round(b + (255 - b) * 0.5)
-                dark_r = round(r * 0.5); dark_g = round(g * 0.5); dark_b = round(b * 0.5)
-                exposure_color_map[group[0]] = f"#{light_r:02x}{light_g:02x}{light_b:02x}"
-                exposure_color_map[group[1]] = f"#{dark_r:02x}{dark_g:02x}{dark_b:02x}"
-            elif len(group) == 3:
-                # Three exposures: low→light, mid→base, high→dark
-                light_r = round(r + (255 - r) * 0.5); light_g = round(g + (255 - g) * 0.5); light_b = round(b + (255 - b) * 0.5)
-                dark_r = round(r * 0.5); dark_g = round(g * 0.5); dark_b = round(b * 0.5)
-                exposure_color_map[group[0]] = f"#{light_r:02x}{light_g:02x}{light_b:02x}"
-                exposure_color_map[group[1]] = base_hex
-                exposure_color_map[group[2]] = f"#{dark_r:02x}{dark_g:02x}{dark_b:02x}"
-        
-        # Create legend entries for each exposure time with its color
+        exposure_times = self.viewer.available_exposures
+
+        # Create legend entries for each exposure time with its color.
+        # Colors come from the viewer's table so the legend always matches the cards.
         for exp_time in exposure_times:
-            color_hex = exposure_color_map.get(exp_time, "#ffffff")
+            color_hex = self.viewer.get_exposure_hex(exp_time)
             entry_label = ttk.Label(legend_frame, text=f"{exp_time} ms",
                                     style='Viewer.TLabel', background=color_hex)
             entry_label.pack(fill=tk.X, padx=viewer_config.PADDING, pady=viewer_config.PADDING)
@@ -337,6 +302,10 @@ class ViewerApp:
         file_frame.pack(fill=tk.X, padx=viewer_config.PADDING, pady=viewer_config.PADDING)
         open_button = ttk.Button(file_frame, text="Open Directory", style='ViewerFile.TButton', command=self.open_directory)
         open_button.pack(fill=tk.X, padx=viewer_config.PADDING, pady=viewer_config.PADDING)
+        open_volume_button = ttk.Button(file_frame, text="Open Volume", style='ViewerFile.TButton', command=self.open_volume)
+        open_volume_button.pack(fill=tk.X, padx=viewer_config.PADDING, pady=viewer_config.PADDING)
+        export_volume_button = ttk.Button(file_frame, text="Export Volume", style='ViewerFile.TButton', command=self.export_volume)
+        export_volume_button.pack(fill=tk.X, padx=viewer_config.PADDING, pady=viewer_config.PADDING)
 
     def create_layer_controls(self):
         """Create layer control section."""
@@ -409,7 +378,8 @@ class ViewerApp:
         quality_controls_frame.pack(fill=tk.X, padx=viewer_config.PADDING, pady=viewer_config.PADDING)
 
         # Quality toggle button (modern flat button with outline style)
-        self.quality_button = ttk.Button(quality_controls_frame, text="Fast Render", style="Viewer.TButton", command=self.toggle_quality)
+        self.quality_button = ttk.Button(quality_controls_frame, text=viewer_config.QUALITY_MODE_LABELS[viewer_config.DEFAULT_QUALITY_MODE],
+                                         style="Viewer.TButton", command=self.toggle_quality)
         self.quality_button.pack(fill=tk.X, padx=viewer_config.PADDING, pady=viewer_config.PADDING)
 
         # Opacity controls (Wrap label and button in frame to align right)
@@ -503,12 +473,9 @@ class ViewerApp:
     def apply_opacity(self):
         """Apply the current opacity setting to update the scene."""
         if hasattr(self, 'viewer'):
-            # Update the viewer's layer opacity with the current UI value.
-            self.viewer.layer_opacity = self.layer_opacity
-            # Clear the texture cache to force re-generation with new opacity.
-            self.viewer.texture_cache.clear()
-            # Trigger the quality update so that _update_node_quality_async refreshes all nodes.
-            self.viewer.set_quality_mode(self.viewer.high_quality)
+            # Update the viewer's layer opacity with the current UI value
+            # (a shader uniform, or a color scale refresh without the shader).
+            self.viewer.set_layer_opacity(self.layer_opacity)
             self.status_label.config(text=f"Opacity updated to {self.layer_opacity * 100:.1f}%")
 
     def update_slider_range(self, total_layers):
@@ -559,8 +526,18 @@ class ViewerApp:
         from viewer_3d_panda import Viewer3D
         self.viewer = Viewer3D(self.panda3d)
         
-        # Set up periodic task to update Panda3D (approx 30 FPS).
-        self.root.after(33, self.update_panda3d)
+        if viewer_config.RENDER_LOOP == "paced":
+            # Paced frames at the target rate, fewer while nothing changes
+            self.render_loop = RenderLoop(self.root, self.panda3d, self.viewer,
+                                          viewer_config.RENDER_TARGET_FPS, viewer_config.RENDER_IDLE_FPS,
+                                          on_demand=viewer_config.RENDER_ON_DEMAND)
+            self.render_loop.start()
+            # Redraw when the window comes back, since nothing is drawn while idle
+            for event in ("<Map>", "<FocusIn>", "<Expose>"):
+                self.root.bind(event, lambda e: self.viewer.mark_dirty(), add="+")
+        else:
+            # Set up periodic task to update Panda3D (approx 30 FPS).
+            self.root.after(33, self.update_panda3d)
 
         def _on_close(self):
             self.panda3d.taskMgr.stop()   # stop any running tasks
@@ -590,6 +567,8 @@ class ViewerApp:
             self.panda_frame.winfo_y()
         )
         self.panda3d.win.requestProperties(props)
+        if getattr(self, "viewer", None):
+            self.viewer.mark_dirty()
         
     def update_panda3d(self):
         """Update Panda3D's task manager."""
@@ -599,6 +578,8 @@ class ViewerApp:
     def _on_close(self) -> None:
         """Graceful shutdown when the user exits"""
         try:
+            if getattr(self, "render_loop", None):
+                self.render_loop.stop()
             # Stop Panda’s task manager if it exists (may not if init failed)
             if hasattr(self, "panda3d") and self.panda3d.taskMgr.running:
                 self.panda3d.taskMgr.stop()
@@ -652,92 +633,85 @@ class ViewerApp:
     def open_directory(self):
         directory = filedialog.askdirectory()
         if directory:
-            # Show and reset progress bar
-            self.progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=viewer_config.PADDING)
-            self.progress_bar['value'] = 0
-            
-            # Phase 1: Parsing JSON (UI will update via callback)
-            self.handle_progress("Parsing JSON", immediate=True)
-            
-            # Load directory data (Parse JSON, initialize layers)
-            if self.viewer.load_print_directory(directory,
-                                            on_status_update=self.on_status_update,
-                                            on_progress_update=self.on_progress_update):
-                # Phase 2: Finding images
-                self.handle_progress("Finding images")
-                
-                # Phase 3: Loading layers (once images are found, start loading layers)
-                self.handle_progress("Loading layers", wait_for_layers=True)
-                
-                # Hide progress bar after loading
-                self.progress_bar.pack_forget()
-                
-                # Clear existing toggles
-                for widget in self.type_frame.winfo_children():
-                    widget.destroy()
-                
-                # Rebuild the UI toggles...
-                self.update_slider_range(self.viewer.total_layers)
-                self.build_type_toggles(self.viewer.available_types)
-                self.create_legend_section()
-                self.build_exposure_toggles(self.viewer.available_exposures)
-                
-                # Final status
-                self.status_label.config(
-                    text=f"Loaded {self.viewer.total_layers} layers ({self.viewer.unique_layers} unique)"
-                )
-            else:
-                self.progress_bar.pack_forget()
-                self.status_label.config(text="Error loading directory")
-
-
-    def handle_progress(self, phase, immediate=False, wait_for_layers=False):
-        """Update status text and animate progress bar for the given phase."""
-        try:
-            if phase == "Parsing JSON":
-                target = 10  # Fast step
-            elif phase == "Finding images":
-                target = 50  # Images phase is mid-way
-            elif phase == "Loading layers":
-                target = 100  # Final phase (layers)
+            self._open_print(self.viewer.load_print_directory, directory)
+
+    def open_volume(self):
+        """Open a print previously exported as a single volume file."""
+        volume_path = filedialog.askopenfilename(
+            filetypes=[("Slice volume", f"*{VOLUME_EXTENSION}"), ("All files", "*.*")])
+        if volume_path:
+            self._open_print(self.viewer.load_volume_file, volume_path)
+
+    def export_volume(self):
+        """Export the loaded print to a single memory-mappable volume file."""
+        if getattr(self.viewer, 'print_processor', None) is None:
+            self.status_label.config(text="Nothing to export; open a print first")
+            return
+        volume_path = filedialog.asksaveasfilename(
+            defaultextension=VOLUME_EXTENSION,
+            filetypes=[("Slice volume", f"*{VOLUME_EXTENSION}")])
+        if volume_path:
+            if self.viewer.export_volume(volume_path):
+                self.status_label.config(text=f"Exported volume to {volume_path}")
             else:
-                return
-
-            # Update status text
-            self.status_label.config(text=phase)
-
-            # Handle progress bar updates
-            current = int(self.progress_bar['value'])
+                self.status_label.config(text="Error exporting volume")
+
+    def _open_print(self, load, path):
+        """Read a print on a worker thread with the given viewer loader and rebuild the UI once it is read."""
+        # Show and reset progress bar
+        self.progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=viewer_config.PADDING)
+        self.progress_bar['value'] = 0
+        self.status_label.config(text="Opening print")
+
+        # The loader reports from its worker threads; the UI shows the latest report at a fixed rate
+        self.progress_channel = ProgressChannel()
+        if load(path,
+                on_status_update=self.progress_channel.status,
+                on_progress_update=self.progress_channel.progress,
+                on_done=self._on_print_loaded):
+            self._poll_progress()
+        else:
+            self.progress_bar.pack_forget()
+            self.status_label.config(text="Error loading print")
+
+    def _poll_progress(self):
+        """Show the latest loading progress, then check again after PROGRESS_REFRESH_MS."""
+        update = self.progress_channel.poll()
+        if update:
+            message, value, rate, eta = update
+            self.progress_bar['value'] = value
+            if message:
+                if eta is not None and value < 100:
+                    message = f"{message} (about {eta:.0f} s left)"
+                self.status_label.config(text=message)
+        self._progress_after = self.root.after(viewer_config.PROGRESS_REFRESH_MS, self._poll_progress)
+
+    def _on_print_loaded(self, success):
+        """Called on the main thread once the print is read; its layers then stream into the view."""
+        if getattr(self, "_progress_after", None):
+            self.root.after_cancel(self._progress_after)
+            self._progress_after = None
+        # Hide progress bar after loading
+        self.progress_bar.pack_forget()
+        if not success:
+            self.status_label.config(text="Error loading print")
+            return
 
-            if immediate:
-                # If the step is immediate (like Parsing JSON), update immediately
-                self.progress_bar['value'] = target
-                self.root.update_idletasks()
-                return
+        # Clear existing toggles
+        for widget in self.type_frame.winfo_children():
+            widget.destroy()
 
-            # Standard update for other phases
-            for val in range(current, target + 1):
-                self.progress_bar['value'] = val
-                self.root.update_idletasks()
-                time.sleep(0.01)
-            
-        except Exception as e:
-            print(f"Error during progress update: {e}")
-            self.status_label.config(text=f"Error: {e}")
+        # Rebuild the UI toggles...
+        self.update_slider_range(self.viewer.total_layers)
+        self.build_type_toggles(self.viewer.available_types)
+        self.create_legend_section()
+        self.build_exposure_toggles(self.viewer.available_exposures)
 
+        # Final status
+        self.status_label.config(
+            text=f"Loaded {self.viewer.total_layers} layers ({self.viewer.unique_layers} unique)"
+        )
 
-    def on_status_update(self, message: str):
-        """Callback to update the status label text."""
-        self.status_label.config(text=message)
-        self.root.update_idletasks()
-
-    def on_progress_update(self, value: int, message: str):
-        """Callback to update the progress bar value and optionally the status text."""
-        self.progress_bar['value'] = value
-        if message:
-            self.status_label.config(text=message)
-        self.root.update_idletasks()
-            
     def apply_layer_range(self):
         """Apply the layer range from entry boxes."""
         try:
@@ -748,12 +722,11 @@ class ViewerApp:
             self.status_label.config(text="Invalid layer range values")
         
     def toggle_quality(self):
-        """Toggle between fast and quality render modes."""
-        current_text = self.quality_button.cget('text')
-        is_fast = current_text == "Fast Render"
-        new_text = "Quality Render" if is_fast else "Fast Render"
-        self.quality_button.config(text=new_text)
-        self.viewer.set_quality_mode(is_fast)
+        """Cycle through the auto, fast and quality render modes."""
+        modes = list(viewer_config.QUALITY_MODE_LABELS)
+        mode = modes[(modes.index(self.viewer.quality_mode) + 1) % len(modes)]
+        self.quality_button.config(text=viewer_config.QUALITY_MODE_LABELS[mode])
+        self.viewer.set_quality_mode(mode)
         self.status_label.config(text="Updating render quality...")
         
     def run(self):
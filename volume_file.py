@@ -0,0 +1,144 @@
+import json
+import struct
+from dataclasses import asdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from print_settings_parser import ImageInfo, LayerInfo
+from slice_store import PackedMask, SliceStore
+
+# File layout:
+#   MAGIC (8 bytes) | version (uint32) | reserved (uint32) | header length (uint64)
+#   header (UTF-8 JSON: print metadata, LayerInfo sequence, per-image offset table)
+#   zero padding up to DATA_ALIGNMENT
+#   data section: every unique slice as packed mask bits, back to back, each followed
+#   by its reduced pyramid levels (version 2)
+MAGIC = b"SLICEVOL"
+VOLUME_VERSION = 2
+# Versions this module can read; version 1 files have no pyramid levels
+READABLE_VERSIONS = (1, 2)
+VOLUME_EXTENSION = ".slvol"
+DATA_ALIGNMENT = 4096
+_PREAMBLE = struct.Struct("<8sIIQ")
+
+
+def pack_store(store: SliceStore) -> Tuple[List[Dict], List[np.ndarray]]:
+    """Return the offset table and packed bit chunks for every image (and pyramid level) in a store"""
+    images = []
+    chunks = []
+    offset = 0
+
+    def add_chunk(stored) -> Dict:
+        nonlocal offset
+        mask = stored if isinstance(stored, PackedMask) else PackedMask.from_array(stored)
+        bits = np.ascontiguousarray(mask.bits)
+        entry = {
+            'shape': list(mask.shape),
+            'rows': bits.shape[0],
+            'rowbytes': bits.shape[1],
+            'offset': offset,
+        }
+        chunks.append(bits.ravel())
+        offset += bits.size
+        return entry
+
+    for image_id in store.ids():
+        entry = add_chunk(store.get_stored(image_id))
+        entry['digest'] = store.digest(image_id)
+        entry['levels'] = [add_chunk(level) for level in store.levels(image_id)]
+        images.append(entry)
+    return images, chunks
+
+
+def write_volume(path: str, store: SliceStore, layer_sequence: Sequence[LayerInfo] = (),
+                 layer_height: float = 10.0, pixel_size: float = 7.6) -> None:
+    """Pack a print's slices and layer sequence into a single memory-mappable file"""
+    images, chunks = pack_store(store)
+    header = {
+        'layer_height': layer_height,
+        'pixel_size': pixel_size,
+        'layer_sequence': [asdict(layer) for layer in layer_sequence],
+        'paths': store.paths(),
+        'images': images,
+        'data_size': sum(chunk.size for chunk in chunks),
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_offset = _PREAMBLE.size + len(header_bytes)
+    padding = -data_offset % DATA_ALIGNMENT
+
+    with open(path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, VOLUME_VERSION, 0, len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b"\0" * padding)
+        for chunk in chunks:
+            f.write(memoryview(chunk))
+
+
+class VolumeFile:
+    """A print volume opened for reading; slice data is a read-only np.memmap"""
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            preamble = f.read(_PREAMBLE.size)
+            if len(preamble) != _PREAMBLE.size:
+                raise ValueError(f"Not a slice volume file: {path}")
+            magic, version, _, header_len = _PREAMBLE.unpack(preamble)
+            if magic != MAGIC:
+                raise ValueError(f"Not a slice volume file: {path}")
+            if version not in READABLE_VERSIONS:
+                raise ValueError(f"Unsupported slice volume version {version}: {path}")
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+
+        data_offset = _PREAMBLE.size + header_len
+        data_offset += -data_offset % DATA_ALIGNMENT
+        data_size = self.header['data_size']
+        if data_size:
+            self.data = np.memmap(path, dtype=np.uint8, mode='r', offset=data_offset, shape=(data_size,))
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    @property
+    def layer_height(self) -> float:
+        return self.header['layer_height']
+
+    @property
+    def pixel_size(self) -> float:
+        return self.header['pixel_size']
+
+    def layer_sequence(self) -> List[LayerInfo]:
+        """Rebuild the LayerInfo sequence stored in the header"""
+        return [
+            LayerInfo(sequence_index=layer['sequence_index'],
+                      images=[ImageInfo(**img) for img in layer['images']],
+                      duplicate_index=layer['duplicate_index'])
+            for layer in self.header['layer_sequence']
+        ]
+
+    def _mask(self, entry: Dict) -> PackedMask:
+        rows, rowbytes = entry['rows'], entry['rowbytes']
+        bits = self.data[entry['offset']:entry['offset'] + rows * rowbytes].reshape(rows, rowbytes)
+        return PackedMask(bits, entry['shape'])
+
+    def masks(self) -> List[PackedMask]:
+        """Return a zero-copy PackedMask view for every stored image"""
+        return [self._mask(entry) for entry in self.header['images']]
+
+    def levels(self) -> List[Optional[List[PackedMask]]]:
+        """Return zero-copy views of every image's reduced pyramid levels (None if not stored)"""
+        return [[self._mask(level) for level in entry['levels']] if 'levels' in entry else None
+                for entry in self.header['images']]
+
+    def fill_store(self, store: SliceStore) -> None:
+        """Replace the contents of a store with this volume's images"""
+        masks = self.masks()
+        levels = self.levels()
+        images = self.header['images']
+        store.clear()
+        for path, idx in self.header['paths'].items():
+            store.add(path, masks[idx], images[idx]['digest'], levels[idx])
+
+
+def read_volume(path: str) -> VolumeFile:
+    """Open a volume file written by write_volume"""
+    return VolumeFile(path)
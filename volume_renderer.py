@@ -0,0 +1,266 @@
+import time
+
+import numpy as np
+import cv2
+from panda3d.core import BoundingBox, CardMaker, NodePath, Point3, TransparencyAttrib
+
+import viewer_config
+from shaders import make_volume_shader
+from slice_store import COARSEST_LEVEL
+from texture_builder import build_mask_image, make_table_texture, make_texture_array
+
+# Instances per row of the per-instance data textures
+TABLE_WIDTH = 4096
+
+
+class VolumeChunk:
+    """A run of consecutive layers drawn by one instanced card over its own texture array."""
+    def __init__(self, seqs, image_ids):
+        self.seqs = set(seqs)        # sequence numbers the chunk can draw
+        self.image_ids = image_ids   # its unique images, one texture array page each
+        self.job = None              # future of the texture array being assembled on the thread pool
+        self.node = None
+        self.texture = None
+        self.pages = {}              # image_id -> page index in the texture array
+
+
+class VolumeRenderer:
+    """Draws the visible layer range with instanced cards over 2D texture arrays.
+
+    Every unique slice image in the range becomes a texture array page, and all
+    cards of a chunk are a single draw call. The range is split into chunks of
+    consecutive layers so each array stays within the GPU's texture size and
+    layer limits; if the arrays would exceed VOLUME_VRAM_BUDGET_MB a coarser
+    pyramid level is used. Per-instance page, offset, visibility and color live
+    in small float textures read by the vertex shader, so type/exposure toggles
+    and draw order changes only rewrite those tables.
+
+    Texture arrays are assembled on the viewer's thread pool and attached by
+    attach_ready, a few per frame. A rebuilt range replaces the chunks drawn
+    before it once all of its chunks are attached.
+    """
+    def __init__(self, viewer, epsilon):
+        self.viewer = viewer
+        self.epsilon = epsilon
+        self.shader = make_volume_shader()
+        self.chunks = []         # chunks being drawn
+        self.building = []       # chunks of the next build, replacing self.chunks when all are attached
+        self.seqs = []           # sequence numbers currently drawn
+        self.scale = 1.0
+        self.spacing = 0.0
+        self.aspect = 1.0
+        self.far_first = None    # True when high sequence numbers are drawn first
+
+    def clear(self):
+        for chunk in self.chunks + self.building:
+            if chunk.node is not None:
+                chunk.node.removeNode()
+        self.chunks = []
+        self.building = []
+        self.seqs = []
+        self.far_first = None
+
+    def _visible_seqs(self):
+        v = self.viewer
+        top = v.visible_range['top']
+        bot = v.visible_range['bottom']
+        first = max(1, bot if bot is not None else 1)
+        last = min(v.total_layers, len(v.slice_data), top if top is not None else v.total_layers)
+        return list(range(first, last + 1))
+
+    def _split(self, seqs, max_pages):
+        """Group consecutive layers into [(seqs, image_ids)] with at most max_pages images each."""
+        v = self.viewer
+        groups = []
+        run, image_ids = [], set()
+        for seq in seqs:
+            layer_ids = set(v.slice_data[seq - 1]['image_ids'])
+            if run and len(image_ids | layer_ids) > max_pages:
+                groups.append((run, sorted(image_ids)))
+                run, image_ids = [], set()
+            run.append(seq)
+            image_ids |= layer_ids
+        if run:
+            groups.append((run, sorted(image_ids)))
+        return groups
+
+    def _plan(self, seqs):
+        """Return (level, groups) for the range: the finest level from texture_level whose arrays fit."""
+        v = self.viewer
+        gsg = v.base.win.getGsg()
+        groups = self._split(seqs, max(1, gsg.getMax2dTextureArrayLayers()))
+        budget = viewer_config.VOLUME_VRAM_BUDGET_MB
+        pages = sum(len(image_ids) for _, image_ids in groups)
+        first_id = groups[0][1][0]
+        for level in range(v.texture_level, COARSEST_LEVEL + 1):
+            height, width = v.image_store.shape(first_id, level)
+            # Mipmaps add a third to every page
+            nbytes = pages * height * width * 4 // 3
+            if (max(height, width) <= gsg.getMaxTextureDimension()
+                    and (budget is None or nbytes <= budget * 1024 * 1024)):
+                break
+        else:
+            print(f"Volume textures exceed the GPU limits or VOLUME_VRAM_BUDGET_MB even at level {level}")
+            return level, groups
+        if level != v.texture_level:
+            print(f"Volume textures use pyramid level {level} instead of {v.texture_level} "
+                  f"({pages} pages in {len(groups)} arrays)")
+        return level, groups
+
+    def build(self):
+        """Plan the visible range into chunks and start assembling their texture arrays."""
+        v = self.viewer
+        # Chunks of an earlier unfinished build are dropped
+        for chunk in self.building:
+            if chunk.node is not None:
+                chunk.node.removeNode()
+        self.building = []
+        if not v.slice_data:
+            return
+        seqs = self._visible_seqs()
+        if not any(v.slice_data[seq - 1]['image_ids'] for seq in seqs):
+            self.clear()
+            return
+
+        level, groups = self._plan(seqs)
+        height, width = v.image_store.shape(groups[0][1][0])
+        self.spacing, self.scale = v._layer_geometry(height, width)
+        self.aspect = width / height
+        for chunk_seqs, image_ids in groups:
+            chunk = VolumeChunk(chunk_seqs, image_ids)
+            chunk.job = v.thread_pool.submit(self._build_texture, image_ids, level)
+            self.building.append(chunk)
+        # The chunks still drawn follow the new range for the layers they have
+        self.seqs = seqs
+        self.update_instances()
+
+    def _build_texture(self, image_ids, level):
+        """Worker side: return (page map, texture array); all pages share the first page's size."""
+        v = self.viewer
+        images = [build_mask_image(v.image_store.get_mask(image_id, level)) for image_id in image_ids]
+        h, w = images[0].shape
+        pages = np.empty((len(images), h, w), dtype=np.uint8)
+        for page, img in enumerate(images):
+            if img.shape != (h, w):
+                img = cv2.resize(img, (w, h), interpolation=cv2.INTER_NEAREST)
+            pages[page] = img
+        page_map = {image_id: page for page, image_id in enumerate(image_ids)}
+        return page_map, make_texture_array(pages, compress=level > 0, mipmap=True)
+
+    def pending(self):
+        """Return True while texture arrays are being assembled."""
+        return bool(self.building)
+
+    def attach_ready(self, deadline):
+        """Attach finished texture arrays until the deadline (at least one); return True if any were."""
+        attached = False
+        for chunk in self.building:
+            if chunk.job is None or not chunk.job.done():
+                continue
+            if attached and time.perf_counter() >= deadline:
+                break
+            chunk.pages, chunk.texture = chunk.job.result()
+            chunk.job = None
+            self._make_node(chunk)
+            if not self.chunks:
+                # Nothing is drawn yet (first build), so chunks are shown as they arrive
+                chunk.node.reparentTo(self.viewer.root)
+            self._update_chunk_instances(chunk)
+            attached = True
+        if self.building and all(chunk.job is None for chunk in self.building):
+            for chunk in self.chunks:
+                chunk.node.removeNode()
+            self.chunks, self.building = self.building, []
+            for chunk in self.chunks:
+                chunk.node.reparentTo(self.viewer.root)
+        return attached
+
+    def _make_node(self, chunk):
+        cm = CardMaker("volume")
+        cm.setFrame(-self.aspect/2, self.aspect/2, -0.5, 0.5)
+        chunk.node = NodePath(cm.generate())
+        chunk.node.setR(90)
+        chunk.node.setScale(self.scale)
+        chunk.node.setTwoSided(True)
+        chunk.node.setTransparency(TransparencyAttrib.MAlpha)
+        chunk.node.setDepthWrite(False)
+        chunk.node.setBin("transparent", 0)
+        # Instances are offset in the shader, so the card's bounds are replaced by the chunk's
+        # stack; chunks are then culled and sorted back to front like any transparent node
+        cards = max(len(self.viewer.slice_data[seq - 1]['image_ids']) for seq in chunk.seqs)
+        near = -min(chunk.seqs) * self.spacing / self.scale + cards * self.epsilon
+        far = -max(chunk.seqs) * self.spacing / self.scale
+        geom_node = chunk.node.node()
+        geom_node.modifyGeom(0).setBounds(BoundingBox(Point3(-self.aspect/2, far, -0.5),
+                                                     Point3(self.aspect/2, near, 0.5)))
+        geom_node.setFinal(True)
+        chunk.node.setShader(self.shader)
+        chunk.node.setShaderInput("volume_pages", chunk.texture)
+
+    def set_range(self):
+        """Show the current visible range, rebuilding only if it needs layers no chunk has."""
+        seqs = self._visible_seqs()
+        drawable = set().union(*(chunk.seqs for chunk in self.building or self.chunks))
+        if not (self.chunks or self.building) or not drawable.issuperset(seqs):
+            self.build()
+            return
+        self.seqs = seqs
+        self.update_instances()
+
+    def set_toggles(self, image_type=None, exposure=None):
+        """Apply image type / exposure toggles (only the instance tables change)."""
+        self.update_instances()
+
+    def rebuild_textures(self):
+        """Repack the visible range, e.g. after a quality change."""
+        self.build()
+
+    def update_instances(self):
+        """Rewrite the per-instance tables for the current range, toggles and draw order."""
+        for chunk in self.chunks + self.building:
+            if chunk.node is not None:
+                self._update_chunk_instances(chunk)
+
+    def _update_chunk_instances(self, chunk):
+        v = self.viewer
+        seqs = self.seqs[::-1] if self.far_first else self.seqs
+        rows = []
+        for seq in seqs:
+            if seq not in chunk.seqs:
+                continue
+            layer = v.slice_data[seq - 1]
+            for idx, td in enumerate(layer['texture_data']):
+                visible = td['image_type'] in v.enabled_types and td.get('exposure_time') in v.enabled_exposures
+                r, g, b = v.exposure_colors.get(td.get('exposure_time'), (1.0, 1.0, 1.0))
+                rows.append((chunk.pages[td['image_id']],
+                             -seq * self.spacing / self.scale + idx * self.epsilon,
+                             1.0 if visible else 0.0,
+                             r, g, b))
+        count = len(rows)
+        if count == 0:
+            chunk.node.hide()
+            return
+        chunk.node.show()
+
+        width = min(count, TABLE_WIDTH)
+        height = -(-count // width)
+        data = np.zeros((height * width, 6), dtype=np.float32)
+        data[:count] = rows
+        table = np.zeros((height * width, 4), dtype=np.float32)
+        table[:, :3] = data[:, :3]
+        color = np.ones((height * width, 4), dtype=np.float32)
+        color[:, :3] = data[:, 3:]
+        chunk.node.setShaderInput("instance_table", make_table_texture(table.reshape(height, width, 4), "instance_table"))
+        chunk.node.setShaderInput("instance_color", make_table_texture(color.reshape(height, width, 4), "instance_color"))
+        chunk.node.setInstanceCount(count)
+
+    def update_draw_order(self, camera):
+        """Draw back to front: flip the instance order when the camera crosses the stack."""
+        if not self.seqs:
+            return
+        cam_y = self.viewer.root.getRelativePoint(camera, Point3(0, 0, 0)).getY()
+        mid_y = -(self.seqs[0] + self.seqs[-1]) / 2 * self.spacing
+        far_first = cam_y > mid_y
+        if far_first != self.far_first:
+            self.far_first = far_first
+            self.update_instances()